@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+#
+# This file is part of the zkfarmer package.
+# (c) Olivier Poitrey <rs@dailymotion.com>
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+
+"""Measure how fast the configuration of a farm is written as PHP.
+
+The streaming renderer, writing the array one node at a time, is
+compared with the previous implementation, rendering the whole file
+in memory before writing it. The time taken and the peak memory
+allocated while writing are reported. Each run writes new content so
+that nothing is skipped.
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/..')
+
+import argparse
+import hashlib
+import json
+import shutil
+import tempfile
+import time
+import tracemalloc
+
+from zkfarmer.conf import ConfFile, ConfPHP, _stat_signature
+
+class PreviousConfPHP(ConfFile):
+    """The PHP writer as it was before streaming"""
+
+    meta = {'"': '\\"', "\0": "\\\0", "\n": "\\n", "\\": "\\\\"}
+    indent = '    '
+
+    def _quotemeta(self, value):
+        return ''.join(self.meta.get(c, c) for c in value)
+
+    def _dump(self, value, lvl=0):
+        if type(value) == int:
+            return value
+        elif isinstance(value, str):
+            return '"%s"' % self._quotemeta(value)
+        elif type(value) == bool:
+            if value:
+                return 'true'
+            return 'false'
+        elif type(value) == dict:
+            indent = lvl * self.indent
+            body = ',\n'.join(['%s"%s" => %s' % (indent + self.indent, self._quotemeta(key), self._dump(val, lvl + 1)) for key, val in list(value.items())])
+            return 'array\n%s(\n%s\n%s)' % (indent, body, indent)
+        elif type(value) == list:
+            return 'array(%s)' % ','.join([str(self._dump(val)) for val in value])
+        else:
+            raise TypeError('php_dump: cannot serialize value: %s' % type(value))
+
+    def _render(self, obj):
+        return '<?php return %s;' % self._dump(obj)
+
+    def _holds(self, obj, content):
+        with open(self.file_path, 'rb') as fd:
+            return fd.read() == content.encode('utf-8')
+
+    def write(self, obj):
+        content = self._render(obj)
+        digest = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        try:
+            signature = _stat_signature(self.file_path)
+        except OSError:
+            signature = None
+        if signature is None:
+            unchanged = False
+        elif self._fingerprint is not None and self._fingerprint[1] == signature:
+            unchanged = self._fingerprint[0] == digest
+        else:
+            unchanged = self._holds(obj, content)
+        if unchanged:
+            self._fingerprint = (digest, signature)
+            return False
+        with self.open(write=True) as fd:
+            fd.write(content)
+        self._fingerprint = (digest, _stat_signature(self.file_path))
+        return True
+
+RENDERERS = (("streaming", ConfPHP), ("previous", PreviousConfPHP))
+
+def node_info(i, generation):
+    """Return a payload looking like what `join` publishes"""
+    return {"hostname": "web%05d.dc%d.example.com" % (i, i % 4),
+            "ip": "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255),
+            "enabled": "1",
+            "weight": str(100 - i % 7 * 10),
+            "datacenter": "dc%d" % (i % 4),
+            "roles": {"web": "1", "api": str(i % 2)},
+            "version": "2.%d.%d" % (generation, i % 13),
+            "load": {"1min": "%.2f" % (i % 17 / 4.0), "5min": "0.50"},
+            "tags": ["tag%d" % (j + i % 5) for j in range(4)]}
+
+def farm(size, generation):
+    return dict(("node%05d" % i, node_info(i, generation)) for i in range(size))
+
+def run(size, repeat, tmpdir):
+    for label, cls in RENDERERS:
+        conf = cls(os.path.join(tmpdir, "%s.php" % label.replace(' ', '_')))
+        # Updating an existing file is what daemons do
+        conf.write(farm(size, repeat + 1))
+        best = None
+        for generation in range(repeat):
+            obj = farm(size, generation)
+            start = time.perf_counter()
+            conf.write(obj)
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        # Tracing allocations slows things down, measure memory apart
+        obj = farm(size, repeat)
+        tracemalloc.start()
+        conf.write(obj)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        yield {"renderer": label,
+               "seconds": best,
+               "peak": peak / 1048576.0,
+               "size": os.path.getsize(conf.file_path) / 1048576.0}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the PHP configuration writer.')
+    parser.add_argument('-n', '--nodes', default=20000, type=int,
+                        help='number of nodes in the farm (default %(default)s)')
+    parser.add_argument('-r', '--repeat', default=3, type=int,
+                        help='keep the best of this many runs (default %(default)s)')
+    parser.add_argument('--json', action='store_true',
+                        help='output results as JSON, one line per renderer')
+    args = parser.parse_args()
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        if not args.json:
+            print("%-10s %9s %12s %10s" % ("renderer", "time", "peak memory", "file size"))
+        for result in run(args.nodes, args.repeat, tmpdir):
+            if args.json:
+                print(json.dumps(dict(result, nodes=args.nodes), sort_keys=True))
+            else:
+                print("%-10s %8.3fs %10.1fMB %8.1fMB" % (result["renderer"], result["seconds"],
+                                                         result["peak"], result["size"]))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
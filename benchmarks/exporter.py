@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+#
+# This file is part of the zkfarmer package.
+# (c) Olivier Poitrey <rs@dailymotion.com>
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+
+"""Measure how the exporter scales with the size of a farm.
+
+Synthetic farms are built in an in-memory ZooKeeper stand-in and the
+exporter is driven through several scenarios. For each of them, the
+time to converge, the number of ZooKeeper operations, the CPU time and
+the peak RSS are reported. Each farm size runs in its own process.
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/..')
+
+import argparse
+import json
+import multiprocessing
+import random
+import resource
+import time
+
+from zkfarmer.conf import ConfBase
+from zkfarmer.testing import FakeKazooClient
+from zkfarmer.utils import serialize
+from zkfarmer.watcher import ZkFarmExporter
+
+ROOT = "/services/bench"
+SIZES = (100, 1000, 10000, 50000)
+
+class MemoryConf(ConfBase):
+    def __init__(self):
+        self.data = None
+        self.writes = 0
+
+    def read(self):
+        return self.data
+
+    def write(self, obj):
+        self.writes += 1
+        self.data = obj
+        return True
+
+def node_name(i):
+    return "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255)
+
+def node_info(i, generation=0):
+    """Return a payload looking like what `join` publishes"""
+    return {"hostname": "web%05d.dc%d.example.com" % (i, i % 4),
+            "ip": node_name(i),
+            "enabled": "1",
+            "weight": str(100 - i % 7 * 10),
+            "datacenter": "dc%d" % (i % 4),
+            "roles": {"web": "1", "api": str(i % 2)},
+            "version": "2.%d.%d" % (generation, i % 13),
+            "load": {"1min": "%.2f" % (i % 17 / 4.0), "5min": "0.50"}}
+
+class Farm(object):
+    """A synthetic farm and the configuration expected from it"""
+
+    def __init__(self, zkconn, size):
+        self.zkconn = zkconn
+        self.expected = {}
+        self.next_id = 0
+        self.zkconn.ensure_path(ROOT)
+        for i in range(size):
+            self.join()
+
+    def join(self):
+        i = self.next_id
+        self.next_id += 1
+        info = node_info(i)
+        self.zkconn.create("%s/%s" % (ROOT, node_name(i)), serialize(info))
+        self.expected[node_name(i)] = info
+
+    def leave(self, name):
+        self.zkconn.delete("%s/%s" % (ROOT, name))
+        del self.expected[name]
+
+    def modify(self, name, generation):
+        info = dict(self.expected[name])
+        info["version"] = "2.%d.0" % generation
+        self.zkconn.set("%s/%s" % (ROOT, name), serialize(info))
+        self.expected[name] = info
+
+def converge(zkconn, exporter, conf, expected):
+    """Run the exporter until it has no more events to process"""
+    ops = sum(zkconn.ops.values())
+    writes = conf.writes
+    start, cpu = time.time(), time.process_time()
+    while exporter.events.qsize():
+        exporter.loop(1, timeout=0, ignore_unknown_transitions=True, drain=True)
+    result = {"latency": time.time() - start,
+              "cpu": time.process_time() - cpu,
+              "zk_ops": sum(zkconn.ops.values()) - ops,
+              "writes": conf.writes - writes,
+              "rss": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0}
+    if conf.data != expected:
+        raise AssertionError("exporter did not converge")
+    return result
+
+def run(size, latency, seed, persistent_watches):
+    rand = random.Random(seed)
+    zkconn = FakeKazooClient(persistent_watches=persistent_watches)
+    zkconn.start()
+    farm = Farm(zkconn, size)
+    zkconn.latency = latency
+    conf = MemoryConf()
+    results = []
+
+    exporter = ZkFarmExporter(zkconn, ROOT, conf)
+    results.append(("cold start", converge(zkconn, exporter, conf, farm.expected)))
+
+    farm.modify(rand.choice(sorted(farm.expected)), 1)
+    results.append(("single change", converge(zkconn, exporter, conf, farm.expected)))
+
+    for name in rand.sample(sorted(farm.expected), max(1, size // 10)):
+        farm.modify(name, 2)
+    results.append(("10% churn", converge(zkconn, exporter, conf, farm.expected)))
+
+    for name in rand.sample(sorted(farm.expected), max(1, size // 4)):
+        farm.leave(name)
+    for i in range(max(1, size // 4)):
+        farm.join()
+    results.append(("mass join/leave", converge(zkconn, exporter, conf, farm.expected)))
+    return results
+
+def _run_in_child(queue, size, latency, seed, persistent_watches):
+    try:
+        queue.put(run(size, latency, seed, persistent_watches))
+    except Exception as e:
+        queue.put(e)
+        raise
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the exporter against synthetic farms.')
+    parser.add_argument('-s', '--sizes', default=','.join(str(s) for s in SIZES),
+                        help='comma separated list of farm sizes (default %(default)s)')
+    parser.add_argument('-l', '--latency', default=0, type=float, metavar='SECONDS',
+                        help='latency added to each ZooKeeper request (default 0)')
+    parser.add_argument('--seed', default=0, type=int,
+                        help='seed used to choose modified nodes')
+    parser.add_argument('--persistent-watches', action='store_true',
+                        help='emulate a server supporting persistent recursive watches')
+    parser.add_argument('--json', action='store_true',
+                        help='output results as JSON, one line per scenario')
+    args = parser.parse_args()
+
+    if not args.json:
+        print("%8s  %-16s %10s %10s %9s %7s %9s" % ("size", "scenario", "latency", "cpu",
+                                                    "zk ops", "writes", "peak rss"))
+    for size in [int(s) for s in args.sizes.split(',')]:
+        # Run each size in a fresh process to get a meaningful peak RSS
+        queue = multiprocessing.Queue()
+        process = multiprocessing.Process(target=_run_in_child,
+                                          args=(queue, size, args.latency, args.seed,
+                                                args.persistent_watches))
+        process.start()
+        results = queue.get()
+        process.join()
+        if isinstance(results, Exception):
+            parser.exit(1, "Farm of %d nodes failed: %s\n" % (size, results))
+        for scenario, result in results:
+            if args.json:
+                result = dict(result, size=size, scenario=scenario)
+                print(json.dumps(result, sort_keys=True))
+            else:
+                print("%8d  %-16s %9.3fs %9.3fs %9d %7d %7.1fMB" % (size, scenario,
+                                                                  result["latency"], result["cpu"],
+                                                                  result["zk_ops"], result["writes"],
+                                                                  result["rss"]))
+            sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
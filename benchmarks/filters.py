@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+#
+# This file is part of the zkfarmer package.
+# (c) Olivier Poitrey <rs@dailymotion.com>
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+
+"""Measure how fast filters are evaluated.
+
+Each filter is built once with `create_filter` and applied to every
+node of a synthetic farm. The number of predicates evaluated per
+second is reported, counting every predicate of the filter for every
+node even when evaluation stops early.
+"""
+
+import sys
+import os
+sys.path.append(os.path.dirname(os.path.abspath(__file__)) + '/..')
+
+import argparse
+import json
+import time
+
+from zkfarmer.utils import create_filter
+
+FILTERS = ("enabled=1",
+           "enabled=1,weight>=50",
+           "datacenter=dc1,roles.api=1,!maintenance",
+           "enabled=1,load.1min<2,version!=2.0.0,hostname",
+           "mysql.replication_delay<20")
+
+def node_info(i):
+    """Return a payload looking like what `join` publishes"""
+    info = {"hostname": "web%05d.dc%d.example.com" % (i, i % 4),
+            "ip": "10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255, i & 255),
+            "enabled": str(int(i % 10 != 0)),
+            "weight": str(100 - i % 7 * 10),
+            "datacenter": "dc%d" % (i % 4),
+            "roles": {"web": "1", "api": str(i % 2)},
+            "version": "2.%d.%d" % (i % 3, i % 13),
+            "load": {"1min": "%.2f" % (i % 17 / 4.0), "5min": "0.50"}}
+    if i % 50 == 0:
+        info["maintenance"] = "1"
+    return info
+
+def run(nodes, filters, repeat):
+    for expression in filters:
+        filter_handler = create_filter(expression)
+        predicates = len(expression.split(','))
+        best = None
+        for i in range(repeat):
+            start = time.process_time()
+            matched = len([info for info in nodes if filter_handler(info)])
+            elapsed = time.process_time() - start
+            best = elapsed if best is None else min(best, elapsed)
+        yield {"filter": expression,
+               "matched": matched,
+               "seconds": best,
+               "predicates_per_second": len(nodes) * predicates / max(best, 1e-9)}
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark filters against a synthetic farm.')
+    parser.add_argument('-n', '--nodes', default=50000, type=int,
+                        help='number of nodes in the farm (default %(default)s)')
+    parser.add_argument('-f', '--filter', action='append', dest='filters',
+                        help='filter to evaluate, may be repeated (default: a built-in set)')
+    parser.add_argument('-r', '--repeat', default=5, type=int,
+                        help='keep the best of this many runs (default %(default)s)')
+    parser.add_argument('--json', action='store_true',
+                        help='output results as JSON, one line per filter')
+    args = parser.parse_args()
+
+    nodes = [node_info(i) for i in range(args.nodes)]
+    if not args.json:
+        print("%-48s %8s %9s %14s" % ("filter", "matched", "time", "predicates/s"))
+    for result in run(nodes, args.filters or FILTERS, args.repeat):
+        if args.json:
+            print(json.dumps(dict(result, nodes=args.nodes), sort_keys=True))
+        else:
+            print("%-48s %8d %8.3fs %14.0f" % (result["filter"], result["matched"],
+                                                result["seconds"],
+                                                result["predicates_per_second"]))
+        sys.stdout.flush()
+
+if __name__ == '__main__':
+    main()
@@ -29,6 +29,7 @@ setup(
     description='Easy distributed server farm management using Apache ZooKeeper.',
     long_description=open('README.md').read(),
     install_requires=parse_requirements('requirements.txt'),
+    extras_require={'msgpack': ['msgpack'], 'cbor': ['cbor2'], 'zstd': ['zstandard']},
     tests_require = [ "nose", "mock" ] + parse_requirements('requirements.txt'),
     test_suite="nose.collector"
 )
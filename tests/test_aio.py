@@ -0,0 +1,124 @@
+import unittest
+import json
+import os
+import signal
+import tempfile
+import threading
+import time
+
+from zkfarmer.aio import AsyncEngine
+from zkfarmer.conf import ConfJSON
+from zkfarmer.watcher import ZkFarmExporter
+from zkfarmer.testing import FakeKazooTestCase
+from mock import Mock
+
+class TestAsyncEngine(FakeKazooTestCase):
+
+    TIMEOUT=5
+
+    def setUp(self):
+        FakeKazooTestCase.setUp(self)
+        self.engine = AsyncEngine()
+        self.thread = None
+
+    def tearDown(self):
+        if self.thread is not None:
+            self.engine.stop()
+            self.thread.join(self.TIMEOUT)
+            self.assertFalse(self.thread.is_alive())
+        self.engine.loop.close()
+        FakeKazooTestCase.tearDown(self)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.engine.run_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wait_for(self, condition):
+        deadline = time.time() + self.TIMEOUT
+        while not condition():
+            self.assertTrue(time.time() < deadline, "condition not met in time")
+            time.sleep(0.01)
+
+    def exporter(self, path, **kwargs):
+        conf = Mock(spec=ConfJSON)
+        ZkFarmExporter(self.client, path, conf, events=self.engine.events, **kwargs)
+        return conf
+
+    def test_export(self):
+        """Test farms are exported from the event loop"""
+        self.client.ensure_path("/services/db/1.1.1.1")
+        self.client.set("/services/db/1.1.1.1", json.dumps({"enabled": "1"}).encode())
+        db = self.exporter("/services/db")
+        web = self.exporter("/services/web")
+        self.start()
+        self.wait_for(lambda: db.write.called and web.write.called)
+        db.write.assert_called_with({"1.1.1.1": {"enabled": "1"}})
+        web.write.assert_called_with({})
+        self.client.create("/services/web/2.2.2.2", json.dumps({"enabled": "0"}).encode())
+        self.wait_for(lambda: web.write.call_count == 2)
+        web.write.assert_called_with({"2.2.2.2": {"enabled": "0"}})
+        self.assertEqual(db.write.call_count, 1)
+
+    def test_quiet_period(self):
+        """Test deadlines of watchers are handled by the event loop"""
+        conf = self.exporter("/services/db", quiet_period=0.3)
+        self.start()
+        self.wait_for(lambda: conf.write.called)
+        start = time.time()
+        self.client.create("/services/db/1.1.1.1", json.dumps({"enabled": "1"}).encode())
+        self.wait_for(lambda: conf.write.call_count == 2)
+        self.assertTrue(time.time() - start >= 0.3)
+        conf.write.assert_called_with({"1.1.1.1": {"enabled": "1"}})
+
+    def test_threads(self):
+        """Test the number of threads does not depend on the number of farms"""
+        confs = [self.exporter("/services/farm%d" % i) for i in range(50)]
+        before = threading.active_count()
+        self.start()
+        self.wait_for(lambda: all(conf.write.called for conf in confs))
+        # The event loop and the worker
+        self.assertEqual(threading.active_count() - before, 2)
+
+    def test_command_executor(self):
+        """Test commands run as subprocesses of the event loop, merging calls"""
+        fd, name = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.unlink, name)
+        executor = self.engine.command_executor("echo run >> %s; sleep 0.2" % name)
+        self.start()
+        for i in range(5):
+            executor()
+        time.sleep(0.1)
+        executor()
+        self.wait_for(lambda: executor.runs == 2)
+        time.sleep(0.1)
+        self.assertEqual(executor.runs, 2)
+        self.assertEqual(executor.merged, 4)
+        self.assertEqual(executor.last_status, 0)
+        with open(name) as f:
+            self.assertEqual(f.read(), "run\nrun\n")
+
+    def test_command_executor_timeout(self):
+        """Test commands running for too long are killed"""
+        executor = self.engine.command_executor("sleep 10", timeout=0.1)
+        self.start()
+        executor()
+        self.wait_for(lambda: executor.runs == 1)
+        self.assertNotEqual(executor.last_status, 0)
+
+    def test_stop_signals(self):
+        """Test the engine stops on signals, waiting for the worker"""
+        self.engine.loop.close()
+        self.engine = AsyncEngine(stop_signals=(signal.SIGTERM,))
+        previous = signal.getsignal(signal.SIGTERM)
+        conf = self.exporter("/services/db")
+        transition = threading.Event()
+        def write(obj):
+            os.kill(os.getpid(), signal.SIGTERM)
+            time.sleep(0.1)
+            transition.set()
+        conf.write.side_effect = write
+        self.engine.run_forever()
+        self.assertTrue(transition.is_set())
+        self.assertEqual(signal.getsignal(signal.SIGTERM), previous)
@@ -95,6 +95,37 @@ class TestConfJSON(TempDirectoryTestCase):
         with open(name) as f:
             self.assertEqual(f.read(), '{             "1": "2"}')
 
+    def test_json_no_read_after_write(self):
+        """Check the file is not read again after being written."""
+        name = "%s/test.json" % self.tmpdir
+        a = conf.Conf(name)
+        self.assertTrue(a.write({"1": "2"}))
+        with patch.object(a, "read") as mock_read:
+            self.assertFalse(a.write({"1": "2"}))
+            self.assertTrue(a.write({"1": "3"}))
+            self.assertEqual(mock_read.call_count, 0)
+        self.assertEqual(a.read(), {"1": "3"})
+
+    def test_json_no_write_if_no_change(self):
+        """Check nothing is written, even temporarily, when there is no change."""
+        name = "%s/test.json" % self.tmpdir
+        a = conf.Conf(name)
+        a.write({"1": "2"})
+        with patch("zkfarmer.conf.tempfile.mkstemp") as mock_mkstemp:
+            self.assertFalse(a.write({"1": "2"}))
+            self.assertFalse(conf.Conf(name).write({"1": "2"}))
+            self.assertEqual(mock_mkstemp.call_count, 0)
+
+    def test_json_external_modification(self):
+        """Check the file is written again after an external modification."""
+        name = "%s/test.json" % self.tmpdir
+        a = conf.Conf(name)
+        a.write({"1": "2"})
+        with open(name, "w") as f:
+            f.write('{"1": "external modification"}')
+        self.assertTrue(a.write({"1": "2"}))
+        self.assertEqual(a.read(), {"1": "2"})
+
     def test_json_write_to_stdout(self):
         """Check we can write the result to stdout."""
         with patch("sys.stdout", new=open("%s/out" % self.tmpdir, "w")) as mock:
@@ -228,6 +259,63 @@ class TestConfPHP(TempDirectoryTestCase):
         self.assertRaises(TypeError, a.write, json)
         self.assertEqual(a.read(), {"1": "2"})
 
+    def test_php_dont_update_if_no_change(self):
+        """Check the file is not rewritten when there is no change."""
+        name = "%s/test.php" % self.tmpdir
+        a = conf.Conf(name)
+        self.assertTrue(a.write({"1": "cc"}))
+        inode = os.stat(name).st_ino
+        with patch("zkfarmer.conf.tempfile.mkstemp") as mock_mkstemp:
+            self.assertFalse(a.write({"1": "cc"}))
+            self.assertFalse(conf.Conf(name).write({"1": "cc"}))
+            self.assertEqual(mock_mkstemp.call_count, 0)
+        self.assertEqual(os.stat(name).st_ino, inode)
+
+    def test_php_sorted_keys(self):
+        """Check keys are written in a stable order."""
+        name = "%s/test.php" % self.tmpdir
+        a = conf.Conf(name)
+        a.write({"b": {"y": "1", "x": "2"}, "a": "3"})
+        with open(name) as f:
+            self.assertEqual(f.read(),
+                             '<?php return array\n(\n'
+                             '    "a" => "3",\n'
+                             '    "b" => array\n'
+                             '    (\n'
+                             '        "x" => "2",\n'
+                             '        "y" => "1"\n'
+                             '    )\n'
+                             ');')
+
+    def test_php_stream_failure(self):
+        """Check a failure while writing leaves no trace."""
+        name = "%s/test.php" % self.tmpdir
+        a = conf.Conf(name)
+        a.write({"1": "2"})
+        with open(name) as f:
+            content = f.read()
+        self.assertRaises(TypeError, a.write, {"1": "2", "2": 1.5})
+        with open(name) as f:
+            self.assertEqual(f.read(), content)
+        self.assertEqual(os.listdir(self.tmpdir), ["test.php"])
+        # Skipped writes do not leave the temporary file either
+        self.assertFalse(conf.Conf(name).write({"1": "2"}))
+        self.assertEqual(os.listdir(self.tmpdir), ["test.php"])
+
+    def test_php_write_unbuffered(self):
+        """Check content larger than the buffer is rendered again."""
+        name = "%s/test.php" % self.tmpdir
+        a = conf.Conf(name)
+        a.max_buffered = 16
+        self.assertTrue(a.write({"1": "2"}))
+        self.assertTrue(a.write({"1": "3", "2": "a long enough value"}))
+        self.assertFalse(a.write({"1": "3", "2": "a long enough value"}))
+        with open(name) as f:
+            self.assertEqual(f.read(), '<?php return array\n(\n'
+                                       '    "1" => "3",\n'
+                                       '    "2" => "a long enough value"\n'
+                                       ');')
+
     def test_php_write_list(self):
         """Check we can write a list correctly."""
         name = "%s/test.php" % self.tmpdir
@@ -296,6 +384,66 @@ class TestConfDir(TempDirectoryTestCase):
                          {"stuff": "12",
                           "otherstuff": {"stuff": "13"}})
 
+    def test_dir_read_only_modified(self):
+        """Check only modified files are read again."""
+        os.makedirs("%s/otherstuff" % self.tmpdir)
+        with open("%s/stuff" % self.tmpdir, "w") as f:
+            f.write("12")
+        with open("%s/otherstuff/stuff" % self.tmpdir, "w") as f:
+            f.write("13")
+        a = conf.Conf(self.tmpdir)
+        a.read()
+        with open("%s/otherstuff/stuff" % self.tmpdir, "w") as f:
+            f.write("145")
+        with patch("zkfarmer.conf.open", create=True, side_effect=open) as mock_open:
+            self.assertEqual(a.read(),
+                             {"stuff": "12",
+                              "otherstuff": {"stuff": "145"}})
+            mock_open.assert_called_once_with("%s/otherstuff/stuff" % self.tmpdir)
+
+    def test_dir_read_changed(self):
+        """Check only changed paths are read when they are provided."""
+        os.makedirs("%s/otherstuff" % self.tmpdir)
+        with open("%s/stuff" % self.tmpdir, "w") as f:
+            f.write("12")
+        a = conf.Conf(self.tmpdir)
+        result = a.read()
+        result["stuff"] = "modified by the caller"
+        with open("%s/stuff" % self.tmpdir, "w") as f:
+            f.write("145")
+        with open("%s/otherstuff/stuff" % self.tmpdir, "w") as f:
+            f.write("13")
+        os.makedirs("%s/new/nested" % self.tmpdir)
+        with open("%s/new/nested/stuff" % self.tmpdir, "w") as f:
+            f.write("14")
+        self.assertEqual(a.read(changed=["%s/otherstuff/stuff" % self.tmpdir,
+                                         "%s/new/nested/stuff" % self.tmpdir,
+                                         "%s/.hidden" % self.tmpdir]),
+                         {"stuff": "12",
+                          "otherstuff": {"stuff": "13"},
+                          "new": {"nested": {"stuff": "14"}}})
+        os.unlink("%s/otherstuff/stuff" % self.tmpdir)
+        self.assertEqual(a.read(changed=["%s/otherstuff/stuff" % self.tmpdir]),
+                         {"stuff": "12",
+                          "otherstuff": {},
+                          "new": {"nested": {"stuff": "14"}}})
+        self.assertEqual(a.read()["stuff"], "145")
+
+    def test_dir_read_changed_removed(self):
+        """Check removed entries are no longer cached."""
+        os.makedirs("%s/otherstuff" % self.tmpdir)
+        with open("%s/stuff" % self.tmpdir, "w") as f:
+            f.write("12")
+        with open("%s/otherstuff/stuff" % self.tmpdir, "w") as f:
+            f.write("13")
+        a = conf.Conf(self.tmpdir)
+        a.read()
+        shutil.rmtree("%s/otherstuff" % self.tmpdir)
+        os.unlink("%s/stuff" % self.tmpdir)
+        self.assertEqual(a.read(changed=["%s/otherstuff" % self.tmpdir,
+                                         "%s/stuff" % self.tmpdir]), {})
+        self.assertEqual(a._entries, {})
+
     def test_dir_write_nested(self):
         """Check we can write nested data in a directory."""
         a = conf.Conf(self.tmpdir)
@@ -309,6 +457,98 @@ class TestConfDir(TempDirectoryTestCase):
         with open("%s/otherstuff/2" % self.tmpdir) as f:
             self.assertEqual(f.read(), "1111")
 
+    def test_dir_write_only_changes(self):
+        """Check only modified entries are written."""
+        a = conf.Conf(self.tmpdir)
+        self.assertTrue(a.write({"stuff": "12",
+                                 "otherstuff": {"1": "1221",
+                                                "2": "1111"}}))
+        with patch("zkfarmer.conf.open", create=True, side_effect=open) as mock_open:
+            self.assertFalse(a.write({"stuff": "12",
+                                      "otherstuff": {"1": "1221",
+                                                     "2": "1111"}}))
+            self.assertEqual(mock_open.call_count, 0)
+            self.assertTrue(a.write({"stuff": "12",
+                                     "otherstuff": {"1": "1222"}}))
+            mock_open.assert_called_once_with("%s/otherstuff/1" % self.tmpdir, "w")
+        with open("%s/otherstuff/1" % self.tmpdir) as f:
+            self.assertEqual(f.read(), "1222")
+        self.assertEqual(os.listdir("%s/otherstuff" % self.tmpdir), ["1"])
+
+    def test_dir_write_external_modification(self):
+        """Check external modifications are reverted."""
+        a = conf.Conf(self.tmpdir)
+        a.write({"stuff": "12", "otherstuff": {"1": "1221"}})
+        with open("%s/otherstuff/1" % self.tmpdir, "w") as f:
+            f.write("externally modified")
+        with open("%s/extra" % self.tmpdir, "w") as f:
+            f.write("extra")
+        self.assertTrue(a.write({"stuff": "12", "otherstuff": {"1": "1221"}}))
+        with open("%s/otherstuff/1" % self.tmpdir) as f:
+            self.assertEqual(f.read(), "1221")
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["otherstuff", "stuff"])
+
+    def test_dir_write_type_change(self):
+        """Check entries can change from file to directory and back."""
+        a = conf.Conf(self.tmpdir)
+        a.write({"stuff": "12"})
+        a.write({"stuff": {"1": "13"}})
+        with open("%s/stuff/1" % self.tmpdir) as f:
+            self.assertEqual(f.read(), "13")
+        a.write({"stuff": "14"})
+        with open("%s/stuff" % self.tmpdir) as f:
+            self.assertEqual(f.read(), "14")
+
+
+class TestConfSharded(TempDirectoryTestCase):
+
+    def _inodes(self):
+        nodes = os.path.join(self.tmpdir, "nodes")
+        return dict((entry, os.stat(os.path.join(nodes, entry)).st_ino)
+                    for entry in os.listdir(nodes))
+
+    def test_sharded_write(self):
+        """Check we write one file per node and a manifest."""
+        a = conf.Conf(self.tmpdir, "php", sharded=True)
+        self.assertTrue(a.write({"1.1.1.1": {"enabled": "1"},
+                                 "2.2.2.2": {"enabled": "0"}}))
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), ["members.php", "nodes"])
+        self.assertEqual(sorted(self._inodes()), ["1.1.1.1.php", "2.2.2.2.php"])
+        with open("%s/members.php" % self.tmpdir) as f:
+            self.assertEqual(f.read(), '<?php return array("1.1.1.1","2.2.2.2");')
+        with open("%s/nodes/1.1.1.1.php" % self.tmpdir) as f:
+            self.assertIn('"enabled" => "1"', f.read())
+
+    def test_sharded_write_changed_only(self):
+        """Check only modified nodes are written again."""
+        a = conf.Conf(self.tmpdir, sharded=True)
+        a.write({"1.1.1.1": {"enabled": "1"}, "2.2.2.2": {"enabled": "0"}})
+        inodes = self._inodes()
+        manifest = os.stat("%s/members.json" % self.tmpdir).st_ino
+        self.assertTrue(a.write({"1.1.1.1": {"enabled": "1"}, "2.2.2.2": {"enabled": "1"}}))
+        self.assertEqual(self._inodes()["1.1.1.1.json"], inodes["1.1.1.1.json"])
+        self.assertNotEqual(self._inodes()["2.2.2.2.json"], inodes["2.2.2.2.json"])
+        self.assertEqual(os.stat("%s/members.json" % self.tmpdir).st_ino, manifest)
+        self.assertFalse(a.write({"1.1.1.1": {"enabled": "1"}, "2.2.2.2": {"enabled": "1"}}))
+        self.assertEqual(a.read(), {"1.1.1.1": {"enabled": "1"}, "2.2.2.2": {"enabled": "1"}})
+
+    def test_sharded_membership(self):
+        """Check joining and leaving nodes update the manifest."""
+        a = conf.Conf(self.tmpdir, "yaml", sharded=True)
+        a.write({"1.1.1.1": {"enabled": "1"}, "2.2.2.2": {"enabled": "0"}})
+        a.write({"1.1.1.1": {"enabled": "1"}, "3.3.3.3": {"enabled": "0"}})
+        self.assertEqual(sorted(self._inodes()), ["1.1.1.1.yaml", "3.3.3.3.yaml"])
+        self.assertEqual(a.read(), {"1.1.1.1": {"enabled": "1"}, "3.3.3.3": {"enabled": "0"}})
+        # Leftovers of a previous run are removed, untouched nodes kept
+        inodes = self._inodes()
+        b = conf.Conf(self.tmpdir, "yaml", sharded=True)
+        self.assertTrue(b.write({"1.1.1.1": {"enabled": "1"}}))
+        self.assertEqual(self._inodes(), {"1.1.1.1.yaml": inodes["1.1.1.1.yaml"]})
+        self.assertEqual(b.read(), {"1.1.1.1": {"enabled": "1"}})
+
+    def test_sharded_bad_format(self):
+        """Check directories cannot be sharded."""
+        self.assertRaises(ValueError, conf.Conf, self.tmpdir, "dir", True)
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,18 +1,22 @@
 import unittest
 import json
+import time
+import os
+import shutil
+import tempfile
 
 from zkfarmer.conf import ConfJSON
-from zkfarmer.watcher import ZkFarmExporter
+from zkfarmer.watcher import ZkFarmExporter, EventQueue
 from zkfarmer.utils import create_filter
-from kazoo.testing import KazooTestCase
-from mock import Mock
+from zkfarmer.testing import FakeKazooClient, FakeKazooTestCase
+from mock import Mock, patch
 
-class TestZkExporter(KazooTestCase):
+class TestZkExporter(FakeKazooTestCase):
 
     TIMEOUT=0.1
 
     def setUp(self):
-        KazooTestCase.setUp(self)
+        FakeKazooTestCase.setUp(self)
         self.conf = Mock(spec=ConfJSON)
 
     def test_start_empty(self):
@@ -67,11 +71,172 @@ class TestZkExporter(KazooTestCase):
         handler = Mock()
         z = ZkFarmExporter(self.client, "/services/db", self.conf, handler)
         z.loop(2, timeout=self.TIMEOUT)
+        handler.assert_called_once_with()
+        handler.reset_mock()
         self.client.set("/services/db/1.1.1.1",
                         json.dumps({"enabled": "0"}))
         z.loop(1, timeout=self.TIMEOUT)
         handler.assert_called_once_with()
 
+    def test_modify_znode_fetch_only_this_one(self):
+        """Test a modification to a znode only fetches this znode"""
+        for ip in ["1.1.1.1", "2.2.2.2", "3.3.3.3"]:
+            self.client.ensure_path("/services/db/%s" % ip)
+            self.client.set("/services/db/%s" % ip,
+                            json.dumps({"enabled": "1"}))
+        z = ZkFarmExporter(self.client, "/services/db", self.conf)
+        z.loop(2, timeout=self.TIMEOUT)
+        with patch.object(self.client, "get", wraps=self.client.get) as get:
+            self.client.set("/services/db/2.2.2.2",
+                            json.dumps({"enabled": "0"}))
+            z.loop(1, timeout=self.TIMEOUT)
+            self.assertEqual([c[0][0] for c in get.call_args_list],
+                             ["/services/db/2.2.2.2"])
+        self.conf.write.assert_called_with({"1.1.1.1": {"enabled": "1"},
+                                            "2.2.2.2": {"enabled": "0"},
+                                            "3.3.3.3": {"enabled": "1"}})
+
+    def test_add_and_remove_znode_fetch_only_new_ones(self):
+        """Test only new znodes are fetched when children are modified"""
+        for ip in ["1.1.1.1", "2.2.2.2"]:
+            self.client.ensure_path("/services/db/%s" % ip)
+            self.client.set("/services/db/%s" % ip,
+                            json.dumps({"enabled": "1"}))
+        z = ZkFarmExporter(self.client, "/services/db", self.conf)
+        z.loop(2, timeout=self.TIMEOUT)
+        with patch.object(self.client, "get_async", wraps=self.client.get_async) as get:
+            self.client.delete("/services/db/1.1.1.1")
+            self.client.create("/services/db/3.3.3.3",
+                               json.dumps({"enabled": "1"}).encode())
+            z.loop(4, timeout=self.TIMEOUT)
+            self.assertEqual([c[0][0] for c in get.call_args_list],
+                             ["/services/db/3.3.3.3"])
+        self.conf.write.assert_called_with({"2.2.2.2": {"enabled": "1"},
+                                            "3.3.3.3": {"enabled": "1"}})
+
+    def test_start_pipelined(self):
+        """Test the initial fetch is done with asynchronous requests"""
+        for ip in ["1.1.1.1", "2.2.2.2", "3.3.3.3"]:
+            self.client.ensure_path("/services/db/%s" % ip)
+            self.client.set("/services/db/%s" % ip,
+                            json.dumps({"enabled": "1"}))
+        with patch.object(self.client, "get", wraps=self.client.get) as get, \
+             patch.object(self.client, "get_async", wraps=self.client.get_async) as get_async:
+            z = ZkFarmExporter(self.client, "/services/db", self.conf, max_inflight=2)
+            z.loop(2, timeout=self.TIMEOUT)
+            self.assertFalse(get.called)
+            self.assertEqual(get_async.call_count, 3)
+        self.assertEqual(len(self.conf.write.call_args[0][0]), 3)
+
+    def test_drain_write_once(self):
+        """Test several modifications are written at once when draining events"""
+        for ip in ["1.1.1.1", "2.2.2.2", "3.3.3.3"]:
+            self.client.ensure_path("/services/db/%s" % ip)
+            self.client.set("/services/db/%s" % ip,
+                            json.dumps({"enabled": "1"}))
+        handler = Mock()
+        z = ZkFarmExporter(self.client, "/services/db", self.conf, handler)
+        z.loop(2, timeout=self.TIMEOUT, drain=True)
+        self.conf.reset_mock()
+        handler.reset_mock()
+        for ip in ["1.1.1.1", "2.2.2.2", "3.3.3.3"]:
+            self.client.set("/services/db/%s" % ip,
+                            json.dumps({"enabled": "0"}))
+        self.client.create("/services/db/4.4.4.4",
+                           json.dumps({"enabled": "0"}).encode())
+        time.sleep(self.TIMEOUT)
+        z.loop(1, timeout=self.TIMEOUT, drain=True)
+        self.conf.write.assert_called_once_with({"1.1.1.1": {"enabled": "0"},
+                                                 "2.2.2.2": {"enabled": "0"},
+                                                 "3.3.3.3": {"enabled": "0"},
+                                                 "4.4.4.4": {"enabled": "0"}})
+        handler.assert_called_once_with()
+
+    def test_quiet_period(self):
+        """Test the configuration is written once the farm is quiet"""
+        self.client.ensure_path("/services/db/1.1.1.1")
+        self.client.set("/services/db/1.1.1.1",
+                        json.dumps({"enabled": "1"}))
+        z = ZkFarmExporter(self.client, "/services/db", self.conf,
+                           quiet_period=0.5)
+        z.loop(2, timeout=self.TIMEOUT)
+        self.assertFalse(self.conf.write.called)
+        for i in range(3):
+            self.client.set("/services/db/1.1.1.1",
+                            json.dumps({"enabled": str(i)}))
+            z.loop(1, timeout=self.TIMEOUT)
+        self.assertFalse(self.conf.write.called)
+        time.sleep(0.5)
+        z.loop(1, timeout=self.TIMEOUT)
+        self.conf.write.assert_called_once_with({"1.1.1.1": {"enabled": "2"}})
+
+    def test_max_staleness(self):
+        """Test the configuration is written even if the farm is never quiet"""
+        self.client.ensure_path("/services/db/1.1.1.1")
+        self.client.set("/services/db/1.1.1.1",
+                        json.dumps({"enabled": "1"}))
+        z = ZkFarmExporter(self.client, "/services/db", self.conf,
+                           quiet_period=10, max_staleness=0.3)
+        z.loop(2, timeout=self.TIMEOUT)
+        self.assertFalse(self.conf.write.called)
+        start = time.time()
+        while not self.conf.write.called and time.time() - start < 2:
+            self.client.set("/services/db/1.1.1.1",
+                            json.dumps({"enabled": "2"}))
+            z.loop(1, timeout=self.TIMEOUT)
+        self.assertTrue(0.3 <= time.time() - start < 1)
+        self.conf.write.assert_called_once_with({"1.1.1.1": {"enabled": "2"}})
+
+    def test_shared_event_queue(self):
+        """Test several exporters can share the same event loop"""
+        self.client.ensure_path("/services/db/1.1.1.1")
+        self.client.set("/services/db/1.1.1.1",
+                        json.dumps({"enabled": "1"}))
+        self.client.ensure_path("/services/cache/2.2.2.2")
+        self.client.set("/services/cache/2.2.2.2",
+                        json.dumps({"enabled": "0"}))
+        events = EventQueue()
+        other_conf = Mock(spec=ConfJSON)
+        z1 = ZkFarmExporter(self.client, "/services/db", self.conf, events=events)
+        z2 = ZkFarmExporter(self.client, "/services/cache", other_conf, events=events)
+        z1.loop(4, timeout=self.TIMEOUT)
+        self.conf.write.assert_called_with({"1.1.1.1": {"enabled": "1"}})
+        other_conf.write.assert_called_with({"2.2.2.2": {"enabled": "0"}})
+        self.client.set("/services/cache/2.2.2.2",
+                        json.dumps({"enabled": "1"}))
+        z1.loop(1, timeout=self.TIMEOUT)
+        other_conf.write.assert_called_with({"2.2.2.2": {"enabled": "1"}})
+        self.assertEqual(self.conf.write.call_count, 1)
+
+    def test_stats(self):
+        """Test ZooKeeper reads and configuration writes are accounted"""
+        self.client.ensure_path("/services/db/1.1.1.1")
+        self.client.set("/services/db/1.1.1.1",
+                        json.dumps({"enabled": "1"}))
+        self.conf.write.return_value = True
+        self.conf.file_path = "/etc/db.json"
+        z = ZkFarmExporter(self.client, "/services/db", self.conf)
+        z.loop(2, timeout=self.TIMEOUT)
+        self.assertEqual(z.stats["zk_reads"], 2)
+        self.assertEqual(z.stats["zk_read_bytes"], len(json.dumps({"enabled": "1"})))
+        self.assertEqual(z.stats["conf_writes"], 1)
+        self.assertTrue(z.last_sync is not None)
+        self.conf.write.return_value = False
+        self.client.set("/services/db/1.1.1.1",
+                        json.dumps({"enabled": "1"}))
+        z.loop(1, timeout=self.TIMEOUT)
+        self.assertEqual(z.stats["zk_reads"], 3)
+        self.assertEqual(z.stats["conf_writes_skipped"], 1)
+        metrics = dict((name, samples) for name, kind, help, samples in z.collect())
+        self.assertEqual(metrics["zkfarmer_zk_reads_total"],
+                         [("", {"watcher": "ZkFarmExporter", "znode": "/services/db",
+                                "conf": "/etc/db.json"}, 3)])
+        # The same farm exported elsewhere is told apart
+        other = Mock(spec=ConfJSON)
+        other.file_path = "/etc/db.php"
+        self.assertNotEqual(ZkFarmExporter(self.client, "/services/db", other).metric_labels(),
+                            z.metric_labels())
+
     def test_filter(self):
         """Test filters are correctly applied"""
         self.client.ensure_path("/services/db/1.1.1.1")
@@ -92,6 +257,93 @@ class TestZkExporter(KazooTestCase):
         self.conf.write.assert_called_with({"2.2.2.2": {"enabled": "1", "weight": "20"},
                                             "4.4.4.4": {"enabled": "1", "weight": "30"}})
 
+    def test_filter_unchanged_output(self):
+        """Test updates of filtered out nodes do not write the configuration"""
+        self.client.ensure_path("/services/db/1.1.1.1")
+        self.client.ensure_path("/services/db/2.2.2.2")
+        self.client.set("/services/db/1.1.1.1",
+                        json.dumps({"enabled": "1", "load": "1"}))
+        self.client.set("/services/db/2.2.2.2",
+                        json.dumps({"enabled": "0", "load": "1"}))
+        handler = Mock()
+        z = ZkFarmExporter(self.client, "/services/db", self.conf, handler,
+                           filter_handler=create_filter("enabled=1"))
+        z.loop(2, timeout=self.TIMEOUT)
+        self.conf.write.assert_called_once_with({"1.1.1.1": {"enabled": "1", "load": "1"}})
+        self.conf.reset_mock()
+        handler.reset_mock()
+        # Stays filtered out
+        self.client.set("/services/db/2.2.2.2",
+                        json.dumps({"enabled": "0", "load": "2"}))
+        self.client.create("/services/db/3.3.3.3",
+                           json.dumps({"enabled": "0"}).encode())
+        z.loop(2, timeout=self.TIMEOUT)
+        self.client.delete("/services/db/3.3.3.3")
+        z.loop(2, timeout=self.TIMEOUT)
+        self.assertFalse(self.conf.write.called)
+        self.assertFalse(handler.called)
+        self.assertEqual(z.stats["node_updates_filtered"], 3)
+        # Leaves the filtered content
+        self.client.set("/services/db/1.1.1.1",
+                        json.dumps({"enabled": "0", "load": "1"}))
+        z.loop(1, timeout=self.TIMEOUT)
+        self.conf.write.assert_called_once_with({})
+        handler.assert_called_once_with()
+        # Enters it
+        self.client.set("/services/db/2.2.2.2",
+                        json.dumps({"enabled": "1", "load": "2"}))
+        z.loop(1, timeout=self.TIMEOUT)
+        self.conf.write.assert_called_with({"2.2.2.2": {"enabled": "1", "load": "2"}})
+        self.assertEqual(z.matching, set(["2.2.2.2"]))
+
+    def test_persistent_watch(self):
+        """Test the farm is watched with a persistent recursive watch when supported"""
+        client = FakeKazooClient(persistent_watches=True)
+        client.start()
+        self.addCleanup(client.stop)
+        for ip in ["1.1.1.1", "2.2.2.2"]:
+            client.ensure_path("/services/db/%s" % ip)
+            client.set("/services/db/%s" % ip, json.dumps({"enabled": "1"}))
+        z = ZkFarmExporter(client, "/services/db", self.conf)
+        z.loop(2, timeout=self.TIMEOUT)
+        self.assertTrue(z.persistent)
+        self.assertEqual(client.ops["add_watch"], 1)
+        self.assertEqual(z.monitored, set())
+        client.set("/services/db/1.1.1.1", json.dumps({"enabled": "0"}))
+        client.create("/services/db/3.3.3.3", json.dumps({"enabled": "1"}).encode())
+        client.delete("/services/db/2.2.2.2")
+        client.create("/services/db/3.3.3.3/child")
+        z.loop(1, timeout=self.TIMEOUT, drain=True)
+        self.conf.write.assert_called_with({"1.1.1.1": {"enabled": "0"},
+                                            "3.3.3.3": {"enabled": "1"}})
+        self.assertEqual(client.ops["get_children"], 1)
+        # The watch is not consumed
+        client.set("/services/db/1.1.1.1", json.dumps({"enabled": "1"}))
+        z.loop(1, timeout=self.TIMEOUT)
+        self.conf.write.assert_called_with({"1.1.1.1": {"enabled": "1"},
+                                            "3.3.3.3": {"enabled": "1"}})
+        # And set again with a new session
+        client.expire_session()
+        z.loop(10, timeout=self.TIMEOUT)
+        self.assertEqual(client.ops["add_watch"], 2)
+        client.set("/services/db/3.3.3.3", json.dumps({"enabled": "2"}))
+        z.loop(1, timeout=self.TIMEOUT)
+        self.conf.write.assert_called_with({"1.1.1.1": {"enabled": "1"},
+                                            "3.3.3.3": {"enabled": "2"}})
+
+    def test_persistent_watch_unsupported(self):
+        """Test nodes are watched one by one when persistent watches are not supported"""
+        self.client.ensure_path("/services/db/1.1.1.1")
+        z = ZkFarmExporter(self.client, "/services/db", self.conf)
+        z.loop(2, timeout=self.TIMEOUT)
+        self.assertFalse(z.persistent)
+        self.assertFalse(z.persistent_watches)
+        self.assertEqual(z.monitored, set(["/services/db/1.1.1.1"]))
+        self.expire_session()
+        z.loop(10, timeout=self.TIMEOUT)
+        # Not tried again
+        self.assertEqual(self.client.ops["add_watch"], 1)
+
     def test_disconnect(self):
         """Test disconnection to ZooKeeper is handled correctly"""
         self.client.ensure_path("/services/db/1.1.1.1")
@@ -102,8 +354,88 @@ class TestZkExporter(KazooTestCase):
         self.conf.write.assert_called_with({"1.1.1.1": {"enabled": "1"}})
         self.conf.reset_mock()
         self.expire_session()
-        z.loop(10, timeout=self.TIMEOUT)
+        with patch.object(self.client, "get_async", wraps=self.client.get_async) as get_async:
+            z.loop(10, timeout=self.TIMEOUT)
+            # Unchanged, checked with its stat only
+            self.assertFalse(get_async.called)
+        self.assertFalse(self.conf.write.called)
+        self.assertEqual(z.stats["nodes_unchanged"], 1)
+
+    def test_disconnect_modified(self):
+        """Test nodes modified while disconnected are fetched again"""
+        for ip in ["1.1.1.1", "2.2.2.2", "3.3.3.3"]:
+            self.client.ensure_path("/services/db/%s" % ip)
+            self.client.set("/services/db/%s" % ip,
+                            json.dumps({"enabled": "1"}))
+        z = ZkFarmExporter(self.client, "/services/db", self.conf)
+        z.loop(2, timeout=self.TIMEOUT)
+        self.expire_session()
+        self.client.set("/services/db/2.2.2.2",
+                        json.dumps({"enabled": "0"}))
+        self.client.delete("/services/db/3.3.3.3")
+        with patch.object(self.client, "get_async", wraps=self.client.get_async) as get_async:
+            z.loop(10, timeout=self.TIMEOUT)
+            self.assertEqual([c[0][0] for c in get_async.call_args_list],
+                             ["/services/db/2.2.2.2"])
+        self.conf.write.assert_called_with({"1.1.1.1": {"enabled": "1"},
+                                            "2.2.2.2": {"enabled": "0"}})
+        self.assertEqual(z.stats["nodes_changed"], 1)
+
+    def test_snapshot(self):
+        """Test exporters start from the snapshot of the previous one"""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        snapshot = os.path.join(tmpdir, "snapshot.json")
+        for ip in ["1.1.1.1", "2.2.2.2"]:
+            self.client.ensure_path("/services/db/%s" % ip)
+            self.client.set("/services/db/%s" % ip,
+                            json.dumps({"enabled": "1"}))
+        z = ZkFarmExporter(self.client, "/services/db", self.conf, snapshot=snapshot)
+        z.loop(2, timeout=self.TIMEOUT)
+        self.assertTrue(os.path.exists(snapshot))
+        self.client.set("/services/db/2.2.2.2",
+                        json.dumps({"enabled": "0"}))
+        with patch.object(self.client, "get_async", wraps=self.client.get_async) as get_async:
+            z = ZkFarmExporter(self.client, "/services/db", self.conf,
+                               filter_handler=create_filter("enabled=1"), snapshot=snapshot)
+            self.assertEqual(z.matching, set(["1.1.1.1", "2.2.2.2"]))
+            z.loop(2, timeout=self.TIMEOUT)
+            self.assertEqual([c[0][0] for c in get_async.call_args_list],
+                             ["/services/db/2.2.2.2"])
         self.conf.write.assert_called_with({"1.1.1.1": {"enabled": "1"}})
+        # Snapshots of other farms are ignored
+        z = ZkFarmExporter(self.client, "/services/cache", self.conf, snapshot=snapshot)
+        self.assertEqual(z.nodes, {})
+
+    def test_snapshot_interval(self):
+        """Test snapshots are not saved more than once per interval"""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        snapshot = os.path.join(tmpdir, "snapshot.json")
+        self.client.ensure_path("/services/db/1.1.1.1")
+        self.client.set("/services/db/1.1.1.1", json.dumps({"enabled": "1"}))
+        z = ZkFarmExporter(self.client, "/services/db", self.conf, snapshot=snapshot,
+                           snapshot_interval=0.3)
+        with patch.object(z.snapshot, "write", wraps=z.snapshot.write) as write:
+            z.loop(2, timeout=self.TIMEOUT)
+            self.assertEqual(write.call_count, 1)
+            for value in ["2", "3"]:
+                self.client.set("/services/db/1.1.1.1", json.dumps({"enabled": value}))
+                z.loop(1, timeout=self.TIMEOUT)
+            self.conf.write.assert_called_with({"1.1.1.1": {"enabled": "3"}})
+            self.assertEqual(write.call_count, 1)
+            self.assertTrue(z.deadline is not None)
+            # Saved once the interval elapsed, without any new event
+            z.loop(1, timeout=1)
+            self.assertEqual(write.call_count, 2)
+            self.assertTrue(z.deadline is None)
+            self.client.set("/services/db/1.1.1.1", json.dumps({"enabled": "4"}))
+            z.loop(1, timeout=self.TIMEOUT)
+            self.assertEqual(write.call_count, 2)
+            # And when closed
+            z.close()
+            self.assertEqual(write.call_count, 3)
+        self.assertEqual(ConfJSON(snapshot).read()["nodes"]["1.1.1.1"][1], {"enabled": "4"})
 
     def test_disconnect_and_still_works(self):
         """Test disconnection to Zookeeper does not disrupt the exporter"""
@@ -4,15 +4,16 @@ from nose.plugins.skip import SkipTest
 
 from zkfarmer.conf import ConfJSON
 from zkfarmer.watcher import ZkFarmJoiner, ZkFarmImporter
-from zkfarmer.utils import create_filter
-from kazoo.testing import KazooTestCase
-from mock import Mock, patch
+from zkfarmer.utils import create_filter, unserialize, CODEC_MAGIC
+from zkfarmer.testing import FakeKazooTestCase
+from mock import Mock, patch, call
+from kazoo.exceptions import OperationTimeoutError
 
 class FakeFileEvent(object):
     """Fake event for fake watchdog observer"""
     src_path = "/fake/root"
 
-class TestZkImporter(KazooTestCase):
+class TestZkImporter(FakeKazooTestCase):
 
     NAME = "zk-test"
     IP = "1.1.1.1"
@@ -131,6 +132,161 @@ class TestZkImporter(KazooTestCase):
                          {"enabled": "57",
                           "hostname": self.NAME})
 
+    def test_local_modification_paths(self):
+        """Test modified paths are given when reading the local configuration"""
+        self.conf.read.return_value = {"enabled": "1",
+                                       "hostname": self.NAME}
+        z = self.Z(self.client, "/services/db", self.conf)
+        z.loop(3, timeout=self.TIMEOUT)
+        self.conf.reset_mock()
+        for path in ["/fake/root/enabled", "/unrelated/path", "/fake/root/weight"]:
+            f = FakeFileEvent()
+            f.src_path = path
+            z.dispatch(f)
+        z.loop(1, timeout=self.TIMEOUT)
+        self.conf.read.assert_called_once_with(changed=["/fake/root/enabled",
+                                                        "/fake/root/weight"])
+        self.assertEqual(z.local_changes, set())
+
+    def test_local_modification_without_remote_read(self):
+        """Test a local modification is pushed without reading the znode"""
+        self.conf.read.return_value = {"enabled": "1",
+                                       "hostname": self.NAME}
+        z = self.Z(self.client, "/services/db", self.conf)
+        z.loop(3, timeout=self.TIMEOUT)
+        self.conf.read.return_value = {"enabled": "0",
+                                       "hostname": self.NAME}
+        with patch.object(self.client, "get", wraps=self.client.get) as get:
+            z.dispatch(FakeFileEvent())
+            z.loop(1, timeout=self.TIMEOUT)
+            self.assertFalse(get.called)
+        self.assertEqual(json.loads(self.client.get("/services/db/%s" % self.IP)[0]),
+                         {"enabled": "0",
+                          "hostname": self.NAME})
+
+    def test_local_modification_concurrent_remote_modification(self):
+        """Test a local modification is pushed even if the cached znode is outdated"""
+        self.conf.read.return_value = {"enabled": "1",
+                                       "hostname": self.NAME}
+        z = self.Z(self.client, "/services/db", self.conf)
+        z.loop(3, timeout=self.TIMEOUT)
+        self.client.set("/services/db/%s" % self.IP,
+                        json.dumps({"enabled": "2"}))
+        self.conf.read.return_value = {"enabled": "0",
+                                       "hostname": self.NAME}
+        payload_bytes = z.stats["payload_bytes"]
+        z.dispatch(FakeFileEvent())
+        z.loop(3, timeout=self.TIMEOUT)
+        data = self.client.get("/services/db/%s" % self.IP)[0]
+        self.assertEqual(json.loads(data),
+                         {"enabled": "0",
+                          "hostname": self.NAME})
+        self.assertEqual(z.stats["payload_bytes"] - payload_bytes, len(data))
+
+    def test_compression(self):
+        """Test large local configurations are compressed"""
+        conf = dict(("key%d" % i, "value") for i in range(100))
+        conf["hostname"] = self.NAME
+        self.conf.read.return_value = conf
+        z = self.Z(self.client, "/services/db", self.conf, compression="zlib",
+                   compress_above=100)
+        z.loop(3, timeout=self.TIMEOUT)
+        data = self.client.get("/services/db/%s" % self.IP)[0]
+        self.assertTrue(data.startswith(CODEC_MAGIC + b"z"))
+        self.assertEqual(unserialize(data), conf)
+        self.assertTrue(z.stats["payload_stored_bytes"] < z.stats["payload_bytes"])
+
+    def test_ignored_local_events(self):
+        """Test temporary files and unrelated paths are ignored"""
+        self.conf.read.return_value = {"enabled": "1",
+                                       "hostname": self.NAME}
+        z = self.Z(self.client, "/fake", self.conf)
+        z.loop(3, timeout=self.TIMEOUT)
+        self.conf.reset_mock()
+        for path in ["/fake/root/.enabled.swp", "/fake/root/enabled~",
+                     "/fake/root/4913", "/fake/rootless"]:
+            f = FakeFileEvent()
+            f.src_path = path
+            z.dispatch(f)
+        f = FakeFileEvent()
+        f.is_directory = True
+        f.event_type = "modified"
+        z.dispatch(f)
+        z.loop(1, timeout=self.TIMEOUT)
+        self.assertFalse(self.conf.read.called)
+        self.assertEqual(z.stats["local_events_ignored"], 5)
+
+    def test_debounce_local_events(self):
+        """Test a burst of local events leads to a single synchronization"""
+        self.conf.read.return_value = {"enabled": "1",
+                                       "hostname": self.NAME}
+        z = self.Z(self.client, "/services/db", self.conf, debounce=0.2)
+        z.loop(3, timeout=self.TIMEOUT)
+        self.conf.reset_mock()
+        self.conf.read.return_value = {"enabled": "0",
+                                       "hostname": self.NAME}
+        for i in range(3):
+            z.dispatch(FakeFileEvent())
+        z.loop(1, timeout=self.TIMEOUT)
+        self.assertFalse(self.conf.read.called)
+        z.loop(3, timeout=0.5)
+        self.assertEqual(self.conf.read.call_args_list.count(call(changed=["/fake/root"])), 1)
+        self.assertEqual(z.stats["local_events_collapsed"], 2)
+        self.assertEqual(json.loads(self.client.get("/services/db/%s" % self.IP)[0]),
+                         {"enabled": "0",
+                          "hostname": self.NAME})
+
+    def test_local_modified_without_changes(self):
+        """Test a local event without pending changes does not read the configuration"""
+        self.conf.read.return_value = {"enabled": "1",
+                                       "hostname": self.NAME}
+        z = self.Z(self.client, "/services/db", self.conf)
+        z.loop(3, timeout=self.TIMEOUT)
+        self.conf.reset_mock()
+        z.dispatch(FakeFileEvent())
+        # Handled with the first one
+        z.event("local modified")
+        z.loop(2, timeout=self.TIMEOUT)
+        self.conf.read.assert_called_once_with(changed=["/fake/root"])
+
+    def test_local_modification_zookeeper_failure(self):
+        """Test a local modification is pushed again after a ZooKeeper failure"""
+        self.conf.read.return_value = {"enabled": "1",
+                                       "hostname": self.NAME}
+        z = self.Z(self.client, "/services/db", self.conf)
+        z.loop(3, timeout=self.TIMEOUT)
+        self.conf.read.return_value = {"enabled": "0",
+                                       "hostname": self.NAME}
+        set_node = self.client.set
+        failures = [OperationTimeoutError()]
+        def set_once_failing(*args, **kwargs):
+            if failures:
+                raise failures.pop()
+            return set_node(*args, **kwargs)
+        with patch.object(self.client, "set", side_effect=set_once_failing) as mock_set:
+            z.dispatch(FakeFileEvent())
+            z.loop(2, timeout=self.TIMEOUT)
+            self.assertEqual(mock_set.call_count, 2)
+        self.assertEqual(z.local_changes, set())
+        self.assertEqual(json.loads(self.client.get("/services/db/%s" % self.IP)[0]),
+                         {"enabled": "0",
+                          "hostname": self.NAME})
+
+    def test_existing_znode_resync(self):
+        """Test the whole local configuration is read when our znode already exists"""
+        self.client.ensure_path("/services/db/%s" % self.IP)
+        self.client.set("/services/db/%s" % self.IP,
+                        json.dumps({"enabled": "1"}))
+        self.conf.read.return_value = {"enabled": "0",
+                                       "hostname": self.NAME}
+        z = self.Z(self.client, "/services/db", self.conf)
+        z.loop(3, timeout=self.TIMEOUT)
+        self.conf.read.assert_called_with(changed=None)
+        self.assertFalse(z.local_resync)
+        self.assertEqual(json.loads(self.client.get("/services/db/%s" % self.IP)[0]),
+                         {"enabled": "0",
+                          "hostname": self.NAME})
+
     def test_zookeeper_modification(self):
         """Check if local configuration is *NOT* updated after remote modification"""
         self.conf.read.return_value = {"enabled": "1",
@@ -414,9 +570,9 @@ class TestZkJoiner(TestZkImporter):
                                             "maintainance": "2"})
         # Check the node exists
         n = self.client.get("/services/db/common")
-        self.assertEqual(n[0],
-                         json.dumps({"enabled": "1",
-                                     "maintainance": "2"}))
+        self.assertEqual(json.loads(n[0]),
+                         {"enabled": "1",
+                          "maintainance": "2"})
         self.assertEqual(n[1].ephemeralOwner, 0)
 
     def test_common_node_join_when_local_modifications(self):
@@ -428,8 +584,8 @@ class TestZkJoiner(TestZkImporter):
         z.loop(3, timeout=self.TIMEOUT)
         self.conf.write.assert_called_with({ "enabled": "42" })
         n = self.client.get("/services/db/common")
-        self.assertEqual(n[0],
-                         json.dumps({"enabled": "42"}))
+        self.assertEqual(json.loads(n[0]),
+                         {"enabled": "42"})
 
     def test_common_node_disconnect_and_local_modifications(self):
         """Check that remote modifications take over local modifications for a common node"""
@@ -0,0 +1,76 @@
+import unittest
+import urllib.request
+
+from zkfarmer.metrics import Histogram, MetricsRegistry, histogram_samples, start_metrics_server
+
+class TestHistogram(unittest.TestCase):
+
+    def test_observe(self):
+        """Check values are counted in the appropriate buckets"""
+        h = Histogram([0.1, 1])
+        for value in [0.05, 0.1, 0.5, 3]:
+            h.observe(value)
+        self.assertEqual(h.count, 4)
+        self.assertAlmostEqual(h.sum, 3.65)
+        self.assertEqual(h.cumulative(), [(0.1, 2), (1, 3), (float("inf"), 4)])
+
+class Collector(object):
+
+    def __init__(self, znode, reads):
+        self.znode = znode
+        self.reads = reads
+
+    def collect(self):
+        return [("zk_reads_total", "counter", "Number of reads",
+                 [("", {"znode": self.znode}, self.reads)])]
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def test_render(self):
+        """Check families of several collectors are merged"""
+        registry = MetricsRegistry()
+        first = Collector("/services/db", 3)
+        registry.register(first)
+        registry.register(first)
+        registry.register(Collector('/a "b"', 1))
+        self.assertEqual(registry.render(),
+                         "# HELP zk_reads_total Number of reads\n"
+                         "# TYPE zk_reads_total counter\n"
+                         'zk_reads_total{znode="/services/db"} 3\n'
+                         'zk_reads_total{znode="/a \\"b\\""} 1\n')
+
+    def test_render_histogram(self):
+        """Check rendering of histogram samples"""
+        h = Histogram([0.5])
+        h.observe(0.25)
+        class HistogramCollector(object):
+            def collect(self):
+                return [("duration_seconds", "histogram", "Duration",
+                         histogram_samples(h, {"event": "x"}))]
+        registry = MetricsRegistry()
+        registry.register(HistogramCollector())
+        self.assertEqual(registry.render().splitlines()[2:],
+                         ['duration_seconds_bucket{event="x",le="0.5"} 1',
+                          'duration_seconds_bucket{event="x",le="+Inf"} 1',
+                          'duration_seconds_sum{event="x"} 0.25',
+                          'duration_seconds_count{event="x"} 1'])
+
+    def test_server(self):
+        """Check metrics are served over HTTP"""
+        registry = MetricsRegistry()
+        registry.register(Collector("/services/db", 3))
+        server = start_metrics_server(registry, "127.0.0.1:0")
+        try:
+            url = "http://127.0.0.1:%d/metrics" % server.server_address[1]
+            body = urllib.request.urlopen(url, timeout=5).read().decode("utf-8")
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(body, registry.render())
+
+    def test_invalid_address(self):
+        """Check an invalid address is rejected"""
+        self.assertRaises(ValueError, start_metrics_server, MetricsRegistry(), "localhost:http")
+
+if __name__ == '__main__':
+    unittest.main()
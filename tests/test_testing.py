@@ -0,0 +1,121 @@
+import unittest
+import time
+
+from zkfarmer.testing import FakeKazooClient, FakeKazooTestCase
+from kazoo.client import KazooState
+from kazoo.exceptions import NoNodeError, NodeExistsError, BadVersionError, \
+    NotEmptyError, ConnectionLoss, UnimplementedError
+from kazoo.protocol.states import EventType
+
+class TestFakeKazooClient(FakeKazooTestCase):
+
+    def test_create_and_get(self):
+        """Check nodes can be created and read back"""
+        self.client.ensure_path("/services/db")
+        self.client.create("/services/db/1.1.1.1", b"data")
+        data, stat = self.client.get("/services/db/1.1.1.1")
+        self.assertEqual(data, b"data")
+        self.assertEqual(stat.version, 0)
+        self.assertEqual(self.client.get_children("/services/db"), ["1.1.1.1"])
+        self.assertRaises(NodeExistsError, self.client.create, "/services/db/1.1.1.1")
+        self.assertRaises(NoNodeError, self.client.create, "/other/node")
+        self.assertRaises(NoNodeError, self.client.get, "/other")
+
+    def test_set_versions(self):
+        """Check versions and mzxid are updated on modification"""
+        self.client.create("/node", b"1")
+        stat1 = self.client.get("/node")[1]
+        stat2 = self.client.set("/node", b"2", version=0)
+        self.assertEqual(stat2.version, 1)
+        self.assertTrue(stat2.mzxid > stat1.mzxid)
+        self.assertRaises(BadVersionError, self.client.set, "/node", b"3", version=0)
+
+    def test_delete(self):
+        """Check deletion of nodes"""
+        self.client.ensure_path("/a/b")
+        self.assertRaises(NotEmptyError, self.client.delete, "/a")
+        self.client.delete("/a", recursive=True)
+        self.assertEqual(self.client.exists("/a"), None)
+
+    def test_watches(self):
+        """Check watches are triggered once"""
+        self.client.create("/node", b"1")
+        events = []
+        self.client.get("/node", watch=events.append)
+        self.client.get_children("/", watch=events.append)
+        self.client.set("/node", b"2")
+        self.client.set("/node", b"3")
+        self.client.create("/other")
+        self.assertEqual([(e.type, e.path) for e in events],
+                         [(EventType.CHANGED, "/node"),
+                          (EventType.CHILD, "/")])
+
+    def test_persistent_watches(self):
+        """Check persistent recursive watches, when supported"""
+        self.assertRaises(UnimplementedError, self.client.add_watch, "/", None,
+                          FakeKazooClient.PERSISTENT_RECURSIVE)
+        client = FakeKazooClient(persistent_watches=True)
+        client.start()
+        client.ensure_path("/a")
+        events = []
+        client.add_watch("/a", events.append, FakeKazooClient.PERSISTENT_RECURSIVE)
+        client.create("/a/b", b"1")
+        client.set("/a/b", b"2")
+        client.set("/a/b", b"3")
+        client.create("/c")
+        client.delete("/a/b")
+        self.assertEqual([(e.type, e.path) for e in events],
+                         [(EventType.CREATED, "/a/b"),
+                          (EventType.CHANGED, "/a/b"),
+                          (EventType.CHANGED, "/a/b"),
+                          (EventType.DELETED, "/a/b")])
+
+    def test_async(self):
+        """Check asynchronous variants"""
+        self.client.create("/node", b"1")
+        self.assertEqual(self.client.get_async("/node").get()[0], b"1")
+        result = self.client.get_async("/missing")
+        self.assertFalse(result.successful())
+        self.assertRaises(NoNodeError, result.get)
+        self.assertEqual(self.client.ops["get"], 2)
+
+    def test_expire_session(self):
+        """Check ephemeral nodes and watches vanish with the session"""
+        states = []
+        self.client.add_listener(states.append)
+        self.client.create("/ephemeral", ephemeral=True)
+        self.client.create("/persistent")
+        events = []
+        self.client.get("/persistent", watch=events.append)
+        self.expire_session()
+        self.assertEqual(states, [KazooState.LOST, KazooState.CONNECTED])
+        self.assertEqual(self.client.exists("/ephemeral"), None)
+        self.client.set("/persistent", b"x")
+        self.assertEqual(events, [])
+
+    def test_lose_connection(self):
+        """Check connection loss keeps the session"""
+        states = []
+        self.client.add_listener(states.append)
+        self.client.create("/ephemeral", ephemeral=True)
+        self.lose_connection()
+        self.assertEqual(states, [KazooState.SUSPENDED, KazooState.CONNECTED])
+        self.assertNotEqual(self.client.exists("/ephemeral"), None)
+
+    def test_stopped(self):
+        """Check requests fail when not connected"""
+        self.client.stop()
+        self.assertRaises(ConnectionLoss, self.client.get, "/")
+
+    def test_latency(self):
+        """Check latency is added to requests"""
+        client = FakeKazooClient(latency=0.05)
+        client.start()
+        start = time.time()
+        results = [client.get_async("/") for i in range(5)]
+        for result in results:
+            result.get()
+        self.assertTrue(0.05 <= time.time() - start < 0.2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,8 +1,13 @@
 import unittest
+import os
+import time
+import shutil
+import tempfile
 from mock import Mock, patch
 from socket import socket, AF_INET, SOCK_DGRAM
 
 from zkfarmer import utils
+from kazoo.exceptions import NoNodeError, ConnectionLoss
 
 class TestUtils(unittest.TestCase):
 
@@ -24,6 +29,131 @@ class TestUtils(unittest.TestCase):
         self.assertEqual(utils.unserialize(utils.serialize({1: "2", 3: {"4": "5"}})),
                          {"1": "2", "3": {"4": "5"}})
 
+    def test_serialize_codecs(self):
+        """Check payloads are decoded whatever their codec"""
+        data = {"1": "2", "3": {"4": [5, 6]}}
+        for codec in utils.CODECS:
+            serialized = utils.serialize(data, codec)
+            self.assertEqual(serialized.startswith(utils.CODEC_MAGIC), codec != "json")
+            self.assertEqual(utils.unserialize(serialized), data)
+        self.assertEqual(utils.serialize(data), b'{"1": "2", "3": {"4": [5, 6]}}')
+        self.assertRaises(ValueError, utils.serialize, data, "unknown")
+        self.assertEqual(utils.unserialize(utils.CODEC_MAGIC + b"?garbage"), {})
+
+    def test_serialize_msgpack(self):
+        """Check msgpack payloads"""
+        if "msgpack" not in utils.CODECS:
+            self.skipTest("msgpack is not installed")
+        serialized = utils.serialize({"1": "2"}, "msgpack")
+        self.assertEqual(serialized, utils.CODEC_MAGIC + b"m\x81\xa11\xa12")
+
+    def test_compress(self):
+        """Check large payloads are compressed and detected"""
+        data = dict(("key%d" % i, "value") for i in range(100))
+        for codec in utils.CODECS:
+            serialized = utils.serialize(data, codec)
+            for compression in utils.COMPRESSIONS:
+                self.assertEqual(utils.compress(serialized, compression, len(serialized)), serialized)
+                compressed = utils.compress(serialized, compression, 100)
+                self.assertTrue(len(compressed) < len(serialized))
+                self.assertEqual(utils.unserialize(compressed), data)
+        self.assertRaises(ValueError, utils.compress, serialized, "unknown", 100)
+
+    def test_compress_bounded(self):
+        """Check nested or oversized compressed payloads are rejected"""
+        data = dict(("key%d" % i, "value") for i in range(100))
+        serialized = utils.serialize(data)
+        for compression in utils.COMPRESSIONS:
+            compressed = utils.compress(serialized, compression, 100)
+            nested = utils.compress(compressed + b" " * 200, compression, 100)
+            self.assertEqual(utils.unserialize(nested), {})
+            self.assertEqual(utils._decode(compressed, len(serialized)), data)
+            self.assertRaises(ValueError, utils._decode, compressed, len(serialized) - 1)
+            self.assertEqual(utils.unserialize(compressed[:-4]), {})
+
+    def test_fetch_many(self):
+        """Check we can fetch several nodes with a bounded window"""
+        inflight = []
+        def get_async(path, watch=None):
+            self.assertTrue(len(inflight) < 2)
+            result = Mock()
+            def get():
+                inflight.remove(path)
+                if path == "/b":
+                    raise NoNodeError()
+                return (path.encode(), None)
+            result.get.side_effect = get
+            inflight.append(path)
+            return result
+        zkconn = Mock()
+        zkconn.get_async.side_effect = get_async
+        results = utils.fetch_many(zkconn, ["/a", "/b", "/c", "/d"], max_inflight=2)
+        self.assertEqual(list(results.keys()), ["/a", "/c", "/d"])
+        self.assertEqual(results["/d"], (b"/d", None))
+        self.assertEqual(inflight, [])
+
+    def test_fetch_many_retry(self):
+        """Check requests failing on a connection loss are retried"""
+        def get_async(path, watch=None):
+            result = Mock()
+            result.get.side_effect = path == "/b" and ConnectionLoss() or None
+            result.get.return_value = (path.encode(), None)
+            return result
+        zkconn = Mock()
+        zkconn.get_async.side_effect = get_async
+        zkconn.retry.side_effect = lambda func, *args, **kwargs: func(*args, **kwargs)
+        zkconn.get.side_effect = NoNodeError()
+        results = utils.fetch_many(zkconn, ["/a", "/b", "/c"])
+        self.assertEqual(list(results.keys()), ["/a", "/c"])
+        zkconn.retry.assert_called_once_with(zkconn.get, "/b", watch=None)
+        zkconn.get.side_effect = None
+        zkconn.get.return_value = (b"/b", None)
+        results = utils.fetch_many(zkconn, ["/a", "/b", "/c"])
+        self.assertEqual(list(results.keys()), ["/a", "/b", "/c"])
+
+    def test_command_executor_merge(self):
+        """Check calls received while the command runs are merged"""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        name = os.path.join(tmpdir, "runs")
+        executor = utils.CommandExecutor("echo run >> %s; sleep 0.2" % name)
+        for i in range(5):
+            executor()
+        time.sleep(0.1)
+        executor()
+        for i in range(50):
+            if executor.runs == 2:
+                break
+            time.sleep(0.05)
+        time.sleep(0.1)
+        self.assertEqual(executor.runs, 2)
+        self.assertEqual(executor.last_status, 0)
+        with open(name) as f:
+            self.assertEqual(f.read(), "run\nrun\n")
+
+    def test_command_executor_timeout(self):
+        """Check a command running for too long is killed"""
+        executor = utils.CommandExecutor("sleep 10", timeout=0.1)
+        start = time.time()
+        executor.run()
+        self.assertTrue(time.time() - start < 5)
+        self.assertNotEqual(executor.last_status, 0)
+
+    def test_command_executor_status(self):
+        """Check the exit status of the command is recorded"""
+        executor = utils.CommandExecutor("exit 3")
+        executor.run()
+        self.assertEqual(executor.last_status, 3)
+        self.assertEqual(executor.runs, 1)
+
+    def test_command_executor_labels(self):
+        """Check extra labels identify the metrics of the command"""
+        executor = utils.CommandExecutor("true", labels={"conf": "/etc/db.json"})
+        for name, kind, help, samples in executor.collect():
+            for suffix, labels, value in samples:
+                self.assertEqual(labels["conf"], "/etc/db.json")
+                self.assertEqual(labels["command"], "true")
+
 if __name__ == '__main__':
     unittest.main()
 
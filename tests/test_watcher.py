@@ -0,0 +1,139 @@
+import unittest
+import threading
+import time
+import queue
+
+from mock import Mock
+
+from zkfarmer.watcher import EventQueue, ZkFarmWatcher
+
+class TestEventQueue(unittest.TestCase):
+
+    W = object()
+
+    def test_priority(self):
+        """Check urgent events are received first"""
+        q = EventQueue()
+        q.put(self.W, 2, "children modified")
+        q.put(self.W, 1, "connection lost")
+        q.put(self.W, 2, "node modified", ("a",))
+        self.assertEqual(q.get(0), (self.W, 1, "connection lost", ()))
+        self.assertEqual(q.get(0), (self.W, 2, "children modified", ()))
+        self.assertEqual(q.get(0), (self.W, 2, "node modified", ("a",)))
+        self.assertRaises(queue.Empty, q.get, 0)
+
+    def test_coalesce(self):
+        """Check identical pending events are coalesced"""
+        q = EventQueue()
+        other = object()
+        self.assertTrue(q.put(self.W, 2, "node modified", ("a",), coalesce=True))
+        self.assertFalse(q.put(self.W, 2, "node modified", ("a",), coalesce=True))
+        self.assertTrue(q.put(self.W, 2, "node modified", ("b",), coalesce=True))
+        self.assertTrue(q.put(other, 2, "node modified", ("a",), coalesce=True))
+        self.assertTrue(q.put(self.W, 2, "connection lost"))
+        self.assertTrue(q.put(self.W, 2, "connection lost"))
+        self.assertEqual(q.qsize(), 5)
+        self.assertEqual(q.coalesced, 1)
+        q.get(0)
+        # Not pending anymore
+        self.assertTrue(q.put(self.W, 2, "node modified", ("a",), coalesce=True))
+
+    def test_drain(self):
+        """Check we can get all pending events at once"""
+        q = EventQueue()
+        q.put(self.W, 2, "children modified")
+        q.put(self.W, 1, "connection lost")
+        self.assertEqual(q.drain(), [(self.W, 1, "connection lost", ()),
+                                     (self.W, 2, "children modified", ())])
+        self.assertEqual(q.drain(), [])
+
+    def test_backpressure(self):
+        """Check producers are blocked when the queue is full"""
+        q = EventQueue(maxsize=2)
+        q.consumer = threading.current_thread()
+        q.put(self.W, 2, "a")
+        q.put(self.W, 2, "b")
+        producer = threading.Thread(target=q.put, args=(self.W, 2, "c"))
+        producer.daemon = True
+        producer.start()
+        time.sleep(0.1)
+        self.assertTrue(producer.is_alive())
+        self.assertEqual(q.qsize(), 2)
+        # Urgent events and events from the consumer are not blocked
+        q.put(self.W, 1, "connection lost", block=False)
+        q.put(self.W, 2, "d")
+        self.assertEqual(q.qsize(), 4)
+        q.drain()
+        producer.join(1)
+        self.assertFalse(producer.is_alive())
+        self.assertEqual(q.get(0), (self.W, 2, "c", ()))
+
+class SimpleWatcher(ZkFarmWatcher):
+
+    EVENTS = { "start":    [("initial", "running")],
+               "tick":     [("running", "running"),
+                            ("initial", "initial")],
+               "stop":     [("running", "stopped")] }
+
+    def exec_tick_from_running(self):
+        self.ticks += 1
+    def exec_tick(self):
+        pass
+    def exec_stop(self):
+        return False
+
+class TestZkFarmWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.w = SimpleWatcher(Mock())
+        self.w.ticks = 0
+
+    def test_compiled_transitions(self):
+        """Check the FSM is compiled when the class is created"""
+        self.assertEqual(SimpleWatcher.TRANSITIONS,
+                         {("initial", "start"): ("running", None),
+                          ("running", "tick"): ("running", SimpleWatcher.exec_tick_from_running),
+                          ("initial", "tick"): ("initial", SimpleWatcher.exec_tick),
+                          ("running", "stop"): ("stopped", SimpleWatcher.exec_stop)})
+        self.assertEqual(ZkFarmWatcher.TRANSITIONS, {})
+
+    def test_transitions(self):
+        """Check transitions are executed and timed"""
+        self.w.event("tick")
+        self.w.event("start")
+        self.w.event("tick")
+        self.w.event("stop")
+        self.w.loop(4, timeout=0)
+        self.assertEqual(self.w.ticks, 1)
+        # Handler returned False
+        self.assertEqual(self.w.state, "running")
+        self.assertEqual(sorted(self.w.timings.keys()),
+                         [("stop", "running"), ("tick", "initial"), ("tick", "running")])
+        self.assertEqual(self.w.timings[("tick", "running")].count, 1)
+
+    def test_unknown_transitions(self):
+        """Check unknown transitions are counted"""
+        self.w.event("stop")
+        self.assertRaises(RuntimeError, self.w.loop, 1, timeout=0)
+        self.w.event("stop")
+        self.w.event("stop")
+        self.w.loop(2, timeout=0, ignore_unknown_transitions=True)
+        self.assertEqual(self.w.unknown_transitions, {("stop", "initial"): 3})
+        self.assertEqual(self.w.state, "initial")
+
+    def test_collect_locked(self):
+        """Check metrics are collected and updated under the metrics lock"""
+        self.w._count("zk_writes", 2)
+        collected = []
+        with self.w.metrics_lock:
+            collector = threading.Thread(target=lambda: collected.append(self.w.collect()))
+            collector.daemon = True
+            collector.start()
+            collector.join(0.1)
+            self.assertTrue(collector.is_alive())
+        collector.join(1)
+        metrics = dict((name, samples) for name, kind, help, samples in collected[0])
+        self.assertEqual(metrics["zkfarmer_zk_writes_total"][0][2], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,11 +3,11 @@ import json
 from mock import patch
 
 from zkfarmer.zkfarmer import ZkFarmer
-from zkfarmer.utils import create_filter
-from kazoo.testing import KazooTestCase
+from zkfarmer.utils import create_filter, CODECS
+from zkfarmer.testing import FakeKazooTestCase
 from kazoo.exceptions import BadVersionError
 
-class TestZkFarmer(KazooTestCase):
+class TestZkFarmer(FakeKazooTestCase):
 
     def test_list_nonexistent_node(self):
         """List a node which does not exist."""
@@ -115,6 +115,22 @@ class TestZkFarmer(KazooTestCase):
         self.assertEqual(z.get("/something"),
                          dict(enabled="1", maintainance="0", weight="10"))
 
+    def test_get_many(self):
+        """Get data of several children at once."""
+        z = ZkFarmer(self.client, max_inflight=2)
+        self.assertEqual(z.get_many("/something"), {})
+        for i in range(5):
+            self.client.ensure_path("/something/mysql%d" % i)
+            self.client.set("/something/mysql%d" % i,
+                            json.dumps({"weight": str(i), "enabled": "1"}))
+        with patch.object(self.client, "get", wraps=self.client.get) as get:
+            nodes = z.get_many("/something")
+            self.assertFalse(get.called)
+        self.assertEqual(sorted(nodes), ["mysql%d" % i for i in range(5)])
+        self.assertEqual(nodes["mysql3"], {"weight": "3", "enabled": "1"})
+        self.assertEqual(z.get_many("/something", ["mysql4", "missing", "mysql1"], "weight"),
+                         {"mysql4": "4", "mysql1": "1"})
+
     def test_check(self):
         """Check status of a znode"""
         z = ZkFarmer(self.client)
@@ -146,5 +162,52 @@ class TestZkFarmer(KazooTestCase):
         self.assertEqual(z.check("/something", "5")[0], z.STATUS_OK)
         self.assertEqual(z.check("/something", "4")[0], z.STATUS_CRITICAL)
 
+    def test_check_with_vanished_node(self):
+        """Check nodes removed while checking are reported as failing"""
+        z = ZkFarmer(self.client)
+        self.client.ensure_path("/something")
+        for i in range(3):
+            self.client.ensure_path("/something/mysql%d" % i)
+            self.client.set("/something/mysql%d" % i, json.dumps({"enabled": "1"}))
+        self.client.set("/something", json.dumps({"size": 3,
+                                                  "running_filter": "!maintenance"}))
+        names = z.list("/something")
+        self.client.delete("/something/mysql1")
+        with patch.object(z, "list", return_value=names):
+            status, reason = z.check("/something", "1")
+        self.assertEqual(status, z.STATUS_CRITICAL)
+        self.assertEqual(reason, "2/3 nodes running, 1 nodes failing, max allowed 1, "
+                                 "1 nodes left during the check")
+
+    def test_export_close(self):
+        """Check exporters are closed when exiting"""
+        z = ZkFarmer(self.client)
+        with patch("zkfarmer.zkfarmer.ZkFarmExporter.loop", side_effect=SystemExit), \
+             patch("zkfarmer.zkfarmer.ZkFarmExporter.close") as close:
+            self.assertRaises(SystemExit, z.export_many,
+                              [{"zknode": "/services/db", "conf": None},
+                               {"zknode": "/services/cache", "conf": None}])
+            self.assertEqual(close.call_count, 2)
+
+    def test_codec(self):
+        """Check the codec of a farm"""
+        if "msgpack" not in CODECS:
+            self.skipTest("msgpack is not installed")
+        z = ZkFarmer(self.client)
+        self.assertEqual(z._codec("/something"), "json")
+        self.client.ensure_path("/something")
+        self.client.set("/something", json.dumps({"codec": "msgpack"}))
+        self.assertEqual(z._codec("/something"), "msgpack")
+        self.assertEqual(z._codec("/something", "json"), "json")
+        self.assertRaises(ValueError, z._codec, "/something", "unknown")
+
+    def test_unsupported_farm_codec(self):
+        """Check an unsupported codec property of a farm falls back to json"""
+        z = ZkFarmer(self.client)
+        self.client.ensure_path("/something")
+        self.client.set("/something", json.dumps({"codec": "unknown"}))
+        self.assertEqual(z._codec("/something"), "json")
+        self.assertRaises(ValueError, z._codec, "/something", "unknown")
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,202 @@
+#
+# This file is part of the zkfarmer package.
+# (c) Olivier Poitrey <rs@dailymotion.com>
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+
+"""Run watchers in an asyncio event loop.
+
+The state machines of the watchers are kept as is. Their events are
+dispatched from an asyncio event loop, which also handles deadlines
+and runs the commands executed on changes as asyncio subprocesses.
+Transitions use the synchronous ZooKeeper and filesystem APIs, they
+are run one batch at a time in a single worker thread so that the
+event loop is never blocked.
+
+Whatever the number of farms, the threads used are the event loop,
+the worker, those of the ZooKeeper client and a single watchdog
+observer (with one emitter per watched directory).
+"""
+
+import asyncio
+import concurrent.futures
+import os
+import signal
+import threading
+import time
+
+import logging as _logging
+logger = _logging.getLogger(__name__)
+
+from watchdog.observers import Observer
+
+from .utils import CommandExecutor
+from .watcher import EventQueue, DEFAULT_MAX_EVENTS
+
+class AsyncEventQueue(EventQueue):
+    """Event queue waking up an asyncio event loop when an event is
+    queued, from any thread"""
+
+    def __init__(self, maxsize=0):
+        super(AsyncEventQueue, self).__init__(maxsize)
+        self.loop = None
+        self.ready = None
+
+    def attach(self, loop):
+        """Wake up `loop` on new events, from now on"""
+        self.ready = asyncio.Event()
+        self.loop = loop
+        if self.qsize():
+            self.ready.set()
+
+    def wakeup(self):
+        loop = self.loop
+        if loop is not None:
+            try:
+                loop.call_soon_threadsafe(self.ready.set)
+            except RuntimeError:
+                # The loop is closed
+                pass
+
+    def put(self, *args, **kwargs):
+        queued = super(AsyncEventQueue, self).put(*args, **kwargs)
+        if queued:
+            self.wakeup()
+        return queued
+
+class AsyncCommandExecutor(CommandExecutor):
+    """Run a shell command as an asyncio subprocess each time it is
+    called, with the same guarantees as `CommandExecutor`.
+
+    It can be called from any thread.
+    """
+
+    def __init__(self, command, timeout=None, loop=None, labels=None):
+        super(AsyncCommandExecutor, self).__init__(command, timeout, labels)
+        self.loop = loop
+        self._task = None
+
+    def __call__(self):
+        self.loop.call_soon_threadsafe(self._schedule)
+
+    def _schedule(self):
+        if self._pending:
+            self.merged += 1
+            return
+        self._pending = True
+        if self._task is None or self._task.done():
+            self._task = self.loop.create_task(self._worker())
+
+    async def _worker(self):
+        while self._pending:
+            self._pending = False
+            await self.run()
+
+    async def run(self):
+        """Run the command and wait for its completion"""
+        logger.debug("Execute %r" % self.command)
+        start = time.time()
+        try:
+            process = await asyncio.create_subprocess_shell(self.command,
+                                                            start_new_session=True)
+        except OSError as e:
+            logger.error("Cannot execute %r: %s" % (self.command, e))
+            return
+        try:
+            status = await asyncio.wait_for(process.wait(), self.timeout)
+        except asyncio.TimeoutError:
+            logger.error("Command %r still running after %ss, kill it" % (self.command,
+                                                                         self.timeout))
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            status = await process.wait()
+        self._finished(status, start)
+
+class AsyncEngine(object):
+    """Run the watchers sharing `events` in an asyncio event loop.
+
+    Watchers have to be created with `events`, and importers with
+    `observer`. Commands to execute on changes should be created with
+    `command_executor()`.
+
+    Receiving one of `stop_signals` while `run_forever()` runs in the
+    main thread stops the engine once the current batch is processed.
+    """
+
+    def __init__(self, max_events=DEFAULT_MAX_EVENTS, loop=None, ignore_unknown_transitions=True,
+                 stop_signals=()):
+        self.events = AsyncEventQueue(max_events)
+        self.loop = loop or asyncio.new_event_loop()
+        self.ignore_unknown_transitions = ignore_unknown_transitions
+        self.stop_signals = stop_signals
+        self._observer = None
+        self._stopped = False
+
+    @property
+    def observer(self):
+        """Watchdog observer shared by the importers"""
+        if self._observer is None:
+            self._observer = Observer()
+            self._observer.start()
+        return self._observer
+
+    def command_executor(self, command, timeout=None, labels=None):
+        return AsyncCommandExecutor(command, timeout, self.loop, labels)
+
+    def _consume(self):
+        # Events queued by transitions are never blocked
+        self.events.consumer = threading.current_thread()
+
+    async def run(self):
+        """Process events until `stop()` is called"""
+        loop = asyncio.get_running_loop()
+        self.events.attach(loop)
+        self._stopped = False
+        worker = concurrent.futures.ThreadPoolExecutor(1, "zkfarmer-worker",
+                                                       initializer=self._consume)
+        try:
+            while not self._stopped:
+                timeout = None
+                deadlines = [w.deadline for w in self.events.watchers if w.deadline is not None]
+                if deadlines:
+                    timeout = max(0, min(deadlines) - time.time())
+                try:
+                    await asyncio.wait_for(self.events.ready.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+                self.events.ready.clear()
+                if self._stopped:
+                    break
+                batch = self.events.drain()
+                if len(batch) > 1:
+                    logger.debug("Process a batch of %d events" % len(batch))
+                await loop.run_in_executor(worker, self.events.process, batch,
+                                           self.ignore_unknown_transitions)
+        finally:
+            self.events.loop = None
+            worker.shutdown(wait=True)
+            if self._observer is not None:
+                self._observer.stop()
+                self._observer.join()
+                self._observer = None
+
+    def run_forever(self):
+        """Run the event loop of the engine until `stop()` is called"""
+        handlers = {}
+        for sig in self.stop_signals:
+            handlers[sig] = signal.getsignal(sig)
+            self.loop.add_signal_handler(sig, self.stop)
+        try:
+            self.loop.run_until_complete(self.run())
+        finally:
+            for sig, handler in handlers.items():
+                self.loop.remove_signal_handler(sig)
+                signal.signal(sig, handler)
+
+    def stop(self):
+        """Stop processing events, from any thread"""
+        self._stopped = True
+        self.events.wakeup()
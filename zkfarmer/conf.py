@@ -12,13 +12,18 @@ import shutil
 import json
 import yaml
 import contextlib
+import copy
+import hashlib
+import stat
 import tempfile
 
 # Prevent unstandard !!python/unicode prefixes
 yaml.add_representer(str, lambda dumper, value: dumper.represent_scalar('tag:yaml.org,2002:str', value))
 
 
-def Conf(file, format=None):
+def Conf(file, format=None, sharded=False):
+    if sharded:
+        return ConfSharded(file, format or 'json')
     if format:
         if format == 'json':
             return ConfJSON(file)
@@ -45,8 +50,19 @@ def Conf(file, format=None):
                 raise ValueError('Cannot detect file format')
 
 
+def _stat_signature(path):
+    """Return what tells if a file has been modified"""
+    st = os.lstat(path)
+    return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+
 class ConfBase(object):
-    def read(self):
+    def read(self, changed=None):
+        """Read the configuration.
+
+        `changed` optionally lists the paths modified since the
+        previous read, as a hint to only read those.
+        """
         raise NotImplementedError('%s.read()' % self.__class__.__name__)
 
     def write(self, obj):
@@ -54,8 +70,109 @@ class ConfBase(object):
 
 
 class ConfFile(ConfBase):
+    """Configuration stored in a single file.
+
+    Subclasses render objects with `_render()`, or with `_chunks()` to
+    write them piece by piece. The digest of the rendered content is
+    computed first, without writing anything: the digest of the last
+    written content and the stat signature of the file are kept to
+    tell if it changed without reading the file. Only new content is
+    written, to a temporary file renamed over the configuration.
+
+    Content up to `max_buffered` bytes is kept from the digest to be
+    written, larger content is rendered again.
+    """
+
+    max_buffered = 1 << 20
+
     def __init__(self, file_path):
         self.file_path = file_path
+        self._fingerprint = None
+
+    def _render(self, obj):
+        raise NotImplementedError('%s.write()' % self.__class__.__name__)
+
+    def _chunks(self, obj):
+        """Yield the rendered content of `obj` in pieces"""
+        yield self._render(obj)
+
+    def _digest(self, obj):
+        """Return the digest of the rendered content of `obj` and the
+        rendered chunks, unless larger than `max_buffered`"""
+        digest = hashlib.sha1()
+        chunks = []
+        size = 0
+        for chunk in self._chunks(obj):
+            data = chunk.encode('utf-8')
+            digest.update(data)
+            if chunks is not None:
+                size += len(data)
+                if size > self.max_buffered:
+                    chunks = None
+                else:
+                    chunks.append(data)
+        return digest.hexdigest(), chunks
+
+    def _holds(self, obj, digest):
+        """Tell if the file already holds `obj`, rendered with `digest`"""
+        content = hashlib.sha1()
+        with open(self.file_path, 'rb') as fd:
+            for block in iter(lambda: fd.read(65536), b''):
+                content.update(block)
+        return content.hexdigest() == digest
+
+    def _stage(self, obj, chunks=None):
+        """Write `obj` into a temporary file next to the configuration,
+        from its encoded `chunks` when already rendered.
+
+        Return the name of the file and the digest of its content.
+        """
+        digest = hashlib.sha1()
+        if chunks is None:
+            chunks = (chunk.encode('utf-8') for chunk in self._chunks(obj))
+        tmp, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.file_path)))
+        try:
+            current_umask = os.umask(0)
+            os.umask(current_umask)
+            os.chmod(tmpname, 0o666 & ~current_umask)
+            with os.fdopen(tmp, "wb") as fd:
+                for data in chunks:
+                    fd.write(data)
+                    digest.update(data)
+        except:
+            os.unlink(tmpname)
+            raise
+        return tmpname, digest.hexdigest()
+
+    def write(self, obj):
+        if self.file_path == '-':
+            with self.open(write=True) as fd:
+                for chunk in self._chunks(obj):
+                    fd.write(chunk)
+            return True
+        try:
+            signature = _stat_signature(self.file_path)
+        except OSError:
+            signature = None
+        chunks = None
+        if signature is not None:
+            digest, chunks = self._digest(obj)
+            if self._fingerprint is not None and self._fingerprint[1] == signature:
+                # Untouched since our last write
+                unchanged = self._fingerprint[0] == digest
+            else:
+                unchanged = self._holds(obj, digest)
+            if unchanged:
+                self._fingerprint = (digest, signature)
+                return False
+        tmpname, digest = self._stage(obj, chunks)
+        try:
+            os.rename(tmpname, self.file_path)
+        except:
+            os.unlink(tmpname)
+            raise
+        self._fingerprint = (digest, _stat_signature(self.file_path))
+        return True
 
     @contextlib.contextmanager
     def open(self, write=False):
@@ -68,60 +185,54 @@ class ConfFile(ConfBase):
                 return
             else:
                 raise NotImplementedError('Cannot read configuration from stdin')
-        if not write:
-            yield open(self.file_path, 'r')
-            return
-        tmp, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(self.file_path)))
-        try:
-            current_umask = os.umask(0)
-            os.umask(current_umask)
-            os.chmod(tmpname, 0o666 & ~current_umask)
-            f = os.fdopen(tmp, "w")
-            yield f
-            f.close()
-            os.rename(tmpname, self.file_path)
-        except:
-            os.unlink(tmpname)
-            raise
+        if write:
+            # Files are replaced atomically by write()
+            raise NotImplementedError('Cannot open configuration file for writing')
+        yield open(self.file_path, 'r')
 
 class ConfJSON(ConfFile):
-    def read(self):
+    def read(self, changed=None):
         if os.path.exists(self.file_path):
             with self.open() as fd:
                 return json.load(fd)
 
-    def write(self, obj):
-        try:
-            if self.read() == obj:
-                return
-        except NotImplementedError:
-            pass
-        with self.open(write=True) as fd:
-            json.dump(obj, fd)
+    def _holds(self, obj, digest):
+        return self.read() == obj
+
+    def _render(self, obj):
+        return json.dumps(obj)
 
 
 class ConfYAML(ConfFile):
-    def read(self):
+    def read(self, changed=None):
         if os.path.exists(self.file_path):
             with self.open() as fd:
-                return yaml.load(fd)
+                return yaml.safe_load(fd)
 
-    def write(self, obj):
-        try:
-            if self.read() == obj:
-                return
-        except NotImplementedError:
-            pass
-        with self.open(write=True) as fd:
-            yaml.dump(obj, fd, default_flow_style=False, allow_unicode=True)
+    def _holds(self, obj, digest):
+        return self.read() == obj
+
+    def _render(self, obj):
+        return yaml.dump(obj, default_flow_style=False, allow_unicode=True)
 
 
 class ConfPHP(ConfFile):
+    """Configuration stored as a PHP file returning an array.
+
+    Keys are sorted so the same content is always rendered the same
+    way. The top-level array is written one entry at a time.
+    """
+
     meta = {'"': '\\"', "\0": "\\\0", "\n": "\\n", "\\": "\\\\"}
+    quotemeta = str.maketrans(meta)
     indent = '    '
 
     def _quotemeta(self, value):
-        return ''.join(self.meta.get(c, c) for c in value)
+        # Most values have nothing to quote, and finding out is cheaper
+        # than translating them
+        if '"' in value or '\\' in value or '\n' in value or '\0' in value:
+            return value.translate(self.quotemeta)
+        return value
 
     def _dump(self, value, lvl=0):
         if type(value) == int:
@@ -134,75 +245,295 @@ class ConfPHP(ConfFile):
             return 'false'
         elif type(value) == dict:
             indent = lvl * self.indent
-            body = ',\n'.join(['%s"%s" => %s' % (indent + self.indent, self._quotemeta(key), self._dump(val, lvl + 1)) for key, val in list(value.items())])
+            body = ',\n'.join([self._dump_entry(key, value[key], lvl) for key in sorted(value)])
             return 'array\n%s(\n%s\n%s)' % (indent, body, indent)
         elif type(value) == list:
             return 'array(%s)' % ','.join([str(self._dump(val)) for val in value])
         else:
             raise TypeError('php_dump: cannot serialize value: %s' % type(value))
 
-    def write(self, obj):
-        with self.open(write=True) as fd:
-            php = '<?php return %s;' % self._dump(obj)
-            fd.write(php.encode("utf-8", "ignore"))
+    def _dump_entry(self, key, value, lvl):
+        return '%s"%s" => %s' % ((lvl + 1) * self.indent, self._quotemeta(key), self._dump(value, lvl + 1))
+
+    def _chunks(self, obj):
+        if type(obj) != dict:
+            yield '<?php return %s;' % self._dump(obj)
+            return
+        yield '<?php return array\n(\n'
+        separator = ''
+        for key in sorted(obj):
+            yield separator + self._dump_entry(key, obj[key], 0)
+            separator = ',\n'
+        yield '\n);'
+
+    def _render(self, obj):
+        return ''.join(self._chunks(obj))
 
 
 class ConfDir(ConfFile):
-    def _parse(self, path):
+    """Configuration stored as a directory tree.
+
+    The last written tree is kept in memory with the stat signature of
+    each written entry. As long as those entries are left untouched,
+    only the differences with the new tree are applied on disk.
+
+    When reading, files whose stat signature did not change since the
+    previous read are not read again.
+    """
+
+    def __init__(self, file_path):
+        super(ConfDir, self).__init__(file_path)
+        self._written = None
+        self._signatures = {}
+        # Last read tree and `path -> (signature, value)` of read files
+        self._tree = None
+        self._entries = {}
+
+    def _read_file(self, path, signature, entries):
+        """Return the value of a file, `None` if it cannot be decoded"""
+        cached = self._entries.get(path)
+        if cached is None or cached[0] != signature:
+            with open(path) as fd:
+                try:
+                    cached = (signature, fd.read().strip())
+                except UnicodeDecodeError:
+                    # ignore invalid utf-8 files
+                    cached = (signature, None)
+        entries[path] = cached
+        return cached[1]
+
+    def _parse(self, path, entries):
         struct = {}
-        for entry in os.listdir(path):
-            if entry[0] == '.':
-                # Ignore UNIX "invisible files"
-                continue
-            entry_path = os.path.join(path, entry)
-            if os.path.isdir(entry_path):
-                struct[entry] = self._parse(entry_path)
-            else:
-                with open(entry_path) as fd:
-                    try:
-                        struct[entry] = fd.read().strip().encode('utf-8')
-                    except UnicodeDecodeError:
-                        # ignore invalid utf-8 files
-                        pass
+        with os.scandir(path) as it:
+            for entry in it:
+                if entry.name[0] == '.':
+                    # Ignore UNIX "invisible files"
+                    continue
+                if entry.is_dir():
+                    struct[entry.name] = self._parse(entry.path, entries)
+                else:
+                    st = entry.stat()
+                    value = self._read_file(entry.path,
+                                            (st.st_ino, st.st_size, st.st_mtime_ns),
+                                            entries)
+                    if value is not None:
+                        struct[entry.name] = value
         return struct
 
-    def _dump(self, obj, path):
+    def _refresh(self, tree, parts, path):
+        """Return a copy of `tree`, the content of `path`, with the
+        entry designated by `parts` read again"""
+        tree = dict(tree)
+        name = parts[0]
+        entry_path = os.path.join(path, name)
+        if len(parts) > 1 and type(tree.get(name)) == dict and os.path.isdir(entry_path):
+            tree[name] = self._refresh(tree[name], parts[1:], entry_path)
+            return tree
+        try:
+            st = os.stat(entry_path)
+        except OSError:
+            tree.pop(name, None)
+            # Forget the cached files of the removed entry
+            prefix = entry_path + os.sep
+            for known in [p for p in self._entries if p == entry_path or p.startswith(prefix)]:
+                del self._entries[known]
+            return tree
+        if stat.S_ISDIR(st.st_mode):
+            value = self._parse(entry_path, self._entries)
+        else:
+            value = self._read_file(entry_path,
+                                    (st.st_ino, st.st_size, st.st_mtime_ns),
+                                    self._entries)
+        if value is None:
+            tree.pop(name, None)
+        else:
+            tree[name] = value
+        return tree
+
+    def _remember(self, path):
+        self._signatures[path] = _stat_signature(path)
+
+    def _remove(self, path):
+        """Remove an entry and forget about it"""
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+            prefix = path + os.sep
+            for known in [p for p in self._signatures if p.startswith(prefix)]:
+                del self._signatures[known]
+        else:
+            os.unlink(path)
+        self._signatures.pop(path, None)
+
+    def _untouched(self):
+        """Check nothing we wrote has been modified by someone else"""
+        try:
+            return all(_stat_signature(path) == signature
+                       for path, signature in self._signatures.items())
+        except OSError:
+            return False
+
+    def _dump(self, obj, path, previous=None):
+        """Write `obj` into the directory `path`.
+
+        `previous` is the content we know to be in `path`. When `None`,
+        the actual content is compared instead. Return `True` if
+        something has been modified.
+        """
         if type(obj) != dict:
             raise TypeError('dir_dump: invalid obj type: %s' % type(obj))
 
+        modified = False
         for key, val in list(obj.items()):
             entry_path = os.path.join(path, key)
+            if previous is None:
+                known = None
+            elif key in previous:
+                known = previous[key]
+                if known == val:
+                    continue
+            else:
+                known = {}
             if isinstance(val, (str, int)):
-                if os.path.isdir(entry_path):
-                    shutil.rmtree(entry_path)
-                elif os.path.exists(entry_path):
-                    with open(entry_path) as fd:
-                        if fd.read() == val:
-                            continue
+                if previous is None:
+                    if os.path.isdir(entry_path):
+                        self._remove(entry_path)
+                    elif os.path.exists(entry_path):
+                        with open(entry_path) as fd:
+                            if fd.read() == val:
+                                self._remember(entry_path)
+                                continue
+                elif type(known) == dict and key in previous:
+                    self._remove(entry_path)
                 with open(entry_path, 'w') as fd:
                     fd.write(val)
+                self._remember(entry_path)
+                modified = True
             elif type(val) == dict:
-                if not os.path.isdir(entry_path):
-                    try:
-                        os.unlink(entry_path)
-                    except OSError:
-                        pass
+                if previous is None:
+                    if not os.path.isdir(entry_path):
+                        try:
+                            os.unlink(entry_path)
+                        except OSError:
+                            pass
+                        os.mkdir(entry_path)
+                        modified = True
+                elif type(known) != dict or key not in previous:
+                    if key in previous:
+                        self._remove(entry_path)
                     os.mkdir(entry_path)
-                self._dump(val, entry_path)
+                    known = {}
+                    modified = True
+                if self._dump(val, entry_path, known):
+                    modified = True
             else:
                 raise TypeError('dir_dump: cannot serialize value: %s' % type(val))
 
         # Clean vanished entries at this level
-        for entry in os.listdir(path):
-            if entry not in obj:
-                entry_path = os.path.join(path, entry)
-                if os.path.isdir(entry_path):
-                    shutil.rmtree(entry_path)
-                else:
-                    os.unlink(entry_path)
+        if previous is None:
+            vanished = [entry for entry in os.listdir(path) if entry not in obj]
+        else:
+            vanished = [entry for entry in previous if entry not in obj]
+        for entry in vanished:
+            self._remove(os.path.join(path, entry))
+            modified = True
+        self._remember(path)
+        return modified
 
-    def read(self):
-        return self._parse(self.file_path)
+    def read(self, changed=None):
+        tree = self._tree
+        for path in changed or ():
+            parts = os.path.relpath(path, self.file_path).split(os.sep)
+            if tree is None or parts[0] in (os.curdir, os.pardir):
+                tree = None
+                break
+            if not any(part[0] == '.' for part in parts):
+                tree = self._refresh(tree, parts, self.file_path)
+        if not changed or tree is None:
+            entries = {}
+            tree = self._parse(self.file_path, entries)
+            self._entries = entries
+        self._tree = tree
+        return copy.deepcopy(tree)
 
     def write(self, obj):
-        self._dump(obj, self.file_path)
+        previous, self._written = self._written, None
+        if previous is None or not self._untouched():
+            # Unknown or externally modified content, compare with it
+            self._signatures = {}
+            previous = None
+        modified = self._dump(obj, self.file_path, previous)
+        self._written = copy.deepcopy(obj)
+        return modified
+
+
+class ConfSharded(ConfBase):
+    """Configuration of a farm stored as one file per node.
+
+    Nodes are written in the `nodes` sub-directory, as `NAME.FORMAT`
+    files. The sorted list of their names is written in the
+    `members.FORMAT` manifest. Only the files of modified nodes are
+    written again, the manifest only when nodes join or leave.
+    """
+
+    def __init__(self, dir_path, format='json'):
+        if format not in ('json', 'yaml', 'php'):
+            raise ValueError('Unsupported format for sharded configuration: %s' % format)
+        self.dir_path = dir_path
+        # Like `ConfDir`, the configuration is a directory
+        self.file_path = dir_path
+        self.format = format
+        self.nodes_path = os.path.join(dir_path, 'nodes')
+        self.manifest = Conf(os.path.join(dir_path, 'members.%s' % format), format)
+        self._shards = {}
+        self._written = None
+
+    def _shard(self, name):
+        shard = self._shards.get(name)
+        if shard is None:
+            path = os.path.join(self.nodes_path, '%s.%s' % (name, self.format))
+            shard = self._shards[name] = Conf(path, self.format)
+        return shard
+
+    def read(self, changed=None):
+        members = self.manifest.read()
+        if members is None:
+            return None
+        return dict((name, self._shard(name).read()) for name in members)
+
+    def write(self, obj):
+        if type(obj) != dict:
+            raise TypeError('sharded_dump: invalid obj type: %s' % type(obj))
+        previous, self._written = self._written, None
+        if not os.path.isdir(self.nodes_path):
+            os.makedirs(self.nodes_path)
+        written = {}
+        modified = False
+        for name, value in obj.items():
+            if previous is not None and name in previous and previous[name] == value:
+                written[name] = previous[name]
+                continue
+            if self._shard(name).write(value):
+                modified = True
+            written[name] = copy.deepcopy(value)
+
+        # Nodes are in place before being listed, and listed until removed
+        if previous is None or len(previous) != len(obj) or \
+           any(name not in obj for name in previous):
+            if self.manifest.write(sorted(obj)):
+                modified = True
+        if previous is None:
+            # Remove what may remain from a previous run
+            suffix = '.%s' % self.format
+            vanished = [entry[:-len(suffix)] for entry in os.listdir(self.nodes_path)
+                        if entry.endswith(suffix) and entry[:-len(suffix)] not in obj]
+        else:
+            vanished = [name for name in previous if name not in obj]
+        for name in vanished:
+            try:
+                os.unlink(self._shard(name).file_path)
+                modified = True
+            except OSError:
+                pass
+            del self._shards[name]
+        self._written = written
+        return modified
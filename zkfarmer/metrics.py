@@ -0,0 +1,149 @@
+#
+# This file is part of the zkfarmer package.
+# (c) Olivier Poitrey <rs@dailymotion.com>
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+
+import os
+import bisect
+import threading
+import collections
+import socketserver
+from http.server import BaseHTTPRequestHandler
+
+import logging
+logger = logging.getLogger(__name__)
+
+# Default latency buckets, in seconds
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Histogram(object):
+    """Distribution of observed values into cumulative buckets"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Return a list of `(upper bound, count)`, the last bound being infinite"""
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+def histogram_samples(histogram, labels):
+    """Return the samples of a histogram with the given labels"""
+    samples = []
+    for bound, count in histogram.cumulative():
+        bucket_labels = dict(labels)
+        bucket_labels["le"] = bound
+        samples.append(("_bucket", bucket_labels, count))
+    samples.append(("_sum", labels, histogram.sum))
+    samples.append(("_count", labels, histogram.count))
+    return samples
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{%s}" % ",".join('%s="%s"' % (key, _format_value(value).replace("\\", "\\\\")
+                                                                    .replace('"', '\\"')
+                                                                    .replace("\n", "\\n"))
+                             for key, value in sorted(labels.items()))
+
+class MetricsRegistry(object):
+    """Set of objects exposing metrics.
+
+    Each registered object provides a `collect()` method returning
+    metric families as `(name, type, help, samples)` tuples, samples
+    being `(suffix, labels, value)` tuples.
+    """
+
+    def __init__(self):
+        self.collectors = []
+        self._lock = threading.Lock()
+
+    def register(self, collector):
+        with self._lock:
+            if not any(c is collector for c in self.collectors):
+                self.collectors.append(collector)
+
+    def render(self):
+        """Render all metrics using Prometheus text format"""
+        families = collections.OrderedDict()
+        with self._lock:
+            collectors = list(self.collectors)
+        for collector in collectors:
+            for name, kind, help, samples in collector.collect():
+                family = families.setdefault(name, (kind, help, []))
+                family[2].extend(samples)
+        lines = []
+        for name, (kind, help, samples) in families.items():
+            lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for suffix, labels, value in samples:
+                lines.append("%s%s%s %s" % (name, suffix, _format_labels(labels),
+                                            _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("Metrics request: " + format % args)
+
+class _TCPMetricsServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _UnixMetricsServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+def start_metrics_server(registry, address):
+    """Serve metrics over HTTP in a background thread.
+
+    `address` is either `[host:]port` or `unix:/path/to/socket`.
+    Return the server.
+    """
+    if address.startswith("unix:"):
+        path = address[5:]
+        if os.path.exists(path):
+            os.unlink(path)
+        server = _UnixMetricsServer(path, _MetricsHandler)
+    else:
+        host, _, port = address.rpartition(":")
+        try:
+            port = int(port)
+        except ValueError:
+            raise ValueError("Invalid metrics address: %s" % address)
+        server = _TCPMetricsServer((host or "127.0.0.1", port), _MetricsHandler)
+    server.registry = registry
+    thread = threading.Thread(target=server.serve_forever, name="metrics")
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving metrics on %s" % address)
+    return server
@@ -0,0 +1,417 @@
+#
+# This file is part of the zkfarmer package.
+# (c) Olivier Poitrey <rs@dailymotion.com>
+#
+# For the full copyright and license information, please view the LICENSE
+# file that was distributed with this source code.
+
+"""In-memory stand-in for :class:`kazoo.client.KazooClient`.
+
+Only the subset of the API used by zkfarmer is provided. Watches are
+delivered synchronously from the thread doing the modification, which
+makes scenarios fully deterministic.
+"""
+
+import time
+import itertools
+import collections
+import threading
+import unittest
+
+from kazoo.client import KazooState, KeeperState
+from kazoo.exceptions import NoNodeError, NodeExistsError, BadVersionError, \
+    NotEmptyError, ConnectionLoss, UnimplementedError
+from kazoo.protocol.states import ZnodeStat, WatchedEvent, EventType
+
+
+class FakeAsyncResult(object):
+    """Result of an asynchronous operation, available after the latency"""
+
+    def __init__(self, func, ready_at=None):
+        self.ready_at = ready_at
+        try:
+            self.value = func()
+            self.exception = None
+        except Exception as e:
+            self.value = None
+            self.exception = e
+
+    def _wait(self):
+        if self.ready_at is not None:
+            delay = self.ready_at - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    def ready(self):
+        return self.ready_at is None or time.time() >= self.ready_at
+
+    def successful(self):
+        return self.exception is None
+
+    def get(self, block=True, timeout=None):
+        self._wait()
+        if self.exception is not None:
+            raise self.exception
+        return self.value
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def rawlink(self, callback):
+        self._wait()
+        callback(self)
+
+    def unlink(self, callback):
+        pass
+
+
+class _Node(object):
+    __slots__ = ("data", "czxid", "mzxid", "pzxid", "ctime", "mtime",
+                 "version", "cversion", "owner", "children")
+
+    def __init__(self, data, zxid, owner):
+        self.data = data
+        self.czxid = self.mzxid = self.pzxid = zxid
+        self.ctime = self.mtime = int(time.time() * 1000)
+        self.version = self.cversion = 0
+        self.owner = owner
+        self.children = set()
+
+    def stat(self):
+        return ZnodeStat(self.czxid, self.mzxid, self.ctime, self.mtime,
+                         self.version, self.cversion, 0, self.owner,
+                         len(self.data), len(self.children), self.pzxid)
+
+
+class FakeKazooClient(object):
+    """Pure-Python ZooKeeper client working on an in-memory tree.
+
+    `latency` (in seconds) is added to each synchronous operation and
+    to the completion of each asynchronous one, asynchronous
+    operations being pipelined like with a real server. Issued
+    operations are counted by type in `ops`.
+
+    Persistent recursive watches, added by `add_watch()`, are only
+    supported with `persistent_watches`, like with ZooKeeper 3.6+.
+    """
+
+    # Mode of `add_watch()`, see `kazoo.protocol.states.AddWatchMode`
+    PERSISTENT_RECURSIVE = 1
+
+    def __init__(self, hosts=None, latency=0, persistent_watches=False, **kwargs):
+        self.latency = latency
+        self.persistent_watches = persistent_watches
+        self.ops = collections.Counter()
+        self.bytes_read = 0
+        self.state = KazooState.LOST
+        self.client_state = KeeperState.CLOSED
+        self._listeners = []
+        self._zxid = itertools.count(1)
+        self._sessions = itertools.count(0x100)
+        self._lock = threading.RLock()
+        self._tree = {"/": _Node(b"", 0, 0)}
+        self._data_watches = collections.defaultdict(set)
+        self._child_watches = collections.defaultdict(set)
+        self._recursive_watches = collections.defaultdict(set)
+        self.client_id = (0, b"")
+
+    # Connection handling
+
+    def _set_state(self, state, client_state):
+        self.state = state
+        self.client_state = client_state
+        for listener in list(self._listeners):
+            listener(state)
+
+    def start(self, timeout=15):
+        self.client_id = (next(self._sessions), b"")
+        self._set_state(KazooState.CONNECTED, KeeperState.CONNECTED)
+
+    def stop(self):
+        self._expire_ephemerals()
+        self._set_state(KazooState.LOST, KeeperState.CLOSED)
+
+    def close(self):
+        pass
+
+    @property
+    def connected(self):
+        return self.state == KazooState.CONNECTED
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        self._listeners.remove(listener)
+
+    def retry(self, func, *args, **kwargs):
+        return func(*args, **kwargs)
+
+    # Tree handling
+
+    def _check(self):
+        if self.state != KazooState.CONNECTED:
+            raise ConnectionLoss()
+
+    def _op(self, name):
+        self._check()
+        self.ops[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _async(self, name, func, *args):
+        self._check()
+        self.ops[name] += 1
+        ready_at = self.latency and time.time() + self.latency or None
+        return FakeAsyncResult(lambda: func(*args), ready_at)
+
+    @staticmethod
+    def _parent(path):
+        parent = path.rsplit("/", 1)[0]
+        return parent or "/"
+
+    @staticmethod
+    def _basename(path):
+        return path.rsplit("/", 1)[1]
+
+    def _node(self, path):
+        try:
+            return self._tree[path]
+        except KeyError:
+            raise NoNodeError(path)
+
+    def _fire(self, watches, path, event_type):
+        event = WatchedEvent(event_type, KeeperState.CONNECTED, path)
+        for watch in list(watches.pop(path, ())):
+            watch(event)
+        if watches is self._data_watches and self._recursive_watches:
+            self._fire_recursive(path, event)
+
+    def _fire_recursive(self, path, event):
+        """Deliver an event to the persistent watches of `path` and of
+        its ancestors"""
+        with self._lock:
+            watches = []
+            current = path
+            while True:
+                watches.extend(self._recursive_watches.get(current, ()))
+                if current == "/":
+                    break
+                current = self._parent(current)
+        for watch in watches:
+            watch(event)
+
+    def add_watch(self, path, watch, mode):
+        self._op("add_watch")
+        if not self.persistent_watches:
+            raise UnimplementedError()
+        if mode != self.PERSISTENT_RECURSIVE:
+            raise NotImplementedError('Only persistent recursive watches are supported')
+        with self._lock:
+            self._recursive_watches[path].add(watch)
+
+    def create(self, path, value=b"", acl=None, ephemeral=False,
+               sequence=False, makepath=False):
+        self._op("create")
+        return self._create(path, value, acl, ephemeral, sequence, makepath)
+
+    def _create(self, path, value=b"", acl=None, ephemeral=False,
+                sequence=False, makepath=False):
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        with self._lock:
+            path = path.rstrip("/") or "/"
+            parent = self._parent(path)
+            if parent not in self._tree:
+                if not makepath:
+                    raise NoNodeError(parent)
+                self._ensure_path(parent)
+            if sequence:
+                path = "%s%010d" % (path, self._tree[parent].cversion)
+            if path in self._tree:
+                raise NodeExistsError(path)
+            zxid = next(self._zxid)
+            self._tree[path] = _Node(value, zxid,
+                                     ephemeral and self.client_id[0] or 0)
+            parent_node = self._tree[parent]
+            parent_node.children.add(self._basename(path))
+            parent_node.cversion += 1
+            parent_node.pzxid = zxid
+        self._fire(self._data_watches, path, EventType.CREATED)
+        self._fire(self._child_watches, parent, EventType.CHILD)
+        return path
+
+    def ensure_path(self, path, acl=None):
+        self._check()
+        return self._ensure_path(path)
+
+    def _ensure_path(self, path):
+        path = path.rstrip("/")
+        current = ""
+        for component in path.split("/")[1:]:
+            current = "%s/%s" % (current, component)
+            if current not in self._tree:
+                try:
+                    self._create(current, b"", None, False, False, False)
+                except NodeExistsError:
+                    pass
+        return True
+
+    def exists(self, path, watch=None):
+        self._op("exists")
+        return self._exists(path, watch)
+
+    def _exists(self, path, watch=None):
+        with self._lock:
+            if watch is not None:
+                self._data_watches[path].add(watch)
+            node = self._tree.get(path)
+            return node and node.stat() or None
+
+    def get(self, path, watch=None):
+        self._op("get")
+        return self._get(path, watch)
+
+    def _get(self, path, watch=None):
+        with self._lock:
+            node = self._node(path)
+            if watch is not None:
+                self._data_watches[path].add(watch)
+            self.bytes_read += len(node.data)
+            return node.data, node.stat()
+
+    def get_children(self, path, watch=None, include_data=False):
+        self._op("get_children")
+        return self._get_children(path, watch, include_data)
+
+    def _get_children(self, path, watch=None, include_data=False):
+        with self._lock:
+            node = self._node(path)
+            if watch is not None:
+                self._child_watches[path].add(watch)
+            children = list(node.children)
+            if include_data:
+                return children, node.stat()
+            return children
+
+    def set(self, path, value, version=-1):
+        self._op("set")
+        return self._set(path, value, version)
+
+    def _set(self, path, value, version=-1):
+        if isinstance(value, str):
+            value = value.encode("utf-8")
+        with self._lock:
+            node = self._node(path)
+            if version != -1 and version != node.version:
+                raise BadVersionError(path)
+            node.data = value
+            node.version += 1
+            node.mzxid = next(self._zxid)
+            node.mtime = int(time.time() * 1000)
+            stat = node.stat()
+        self._fire(self._data_watches, path, EventType.CHANGED)
+        return stat
+
+    def delete(self, path, version=-1, recursive=False):
+        self._op("delete")
+        return self._delete(path, version, recursive)
+
+    def _delete(self, path, version=-1, recursive=False):
+        with self._lock:
+            node = self._node(path)
+            if version != -1 and version != node.version:
+                raise BadVersionError(path)
+            if node.children:
+                if not recursive:
+                    raise NotEmptyError(path)
+                for child in list(node.children):
+                    self._delete("%s/%s" % (path.rstrip("/"), child),
+                                 -1, True)
+            self._remove(path)
+        return True
+
+    def _remove(self, path):
+        with self._lock:
+            del self._tree[path]
+            parent = self._parent(path)
+            parent_node = self._tree[parent]
+            parent_node.children.discard(self._basename(path))
+            parent_node.cversion += 1
+            parent_node.pzxid = next(self._zxid)
+        self._fire(self._data_watches, path, EventType.DELETED)
+        self._child_watches.pop(path, None)
+        self._fire(self._child_watches, parent, EventType.CHILD)
+
+    def get_async(self, path, watch=None):
+        return self._async("get", self._get, path, watch)
+
+    def get_children_async(self, path, watch=None, include_data=False):
+        return self._async("get_children", self._get_children, path, watch,
+                           include_data)
+
+    def exists_async(self, path, watch=None):
+        return self._async("exists", self._exists, path, watch)
+
+    def set_async(self, path, value, version=-1):
+        return self._async("set", self._set, path, value, version)
+
+    def create_async(self, path, value=b"", acl=None, ephemeral=False,
+                     sequence=False, makepath=False):
+        return self._async("create", self._create, path, value, acl,
+                           ephemeral, sequence, makepath)
+
+    def delete_async(self, path, version=-1):
+        return self._async("delete", self._delete, path, version, False)
+
+    # Session handling
+
+    def _expire_ephemerals(self):
+        owner = self.client_id[0]
+        with self._lock:
+            paths = sorted((p for p, n in self._tree.items()
+                            if owner and n.owner == owner),
+                           reverse=True)
+        for path in paths:
+            if path in self._tree:
+                self._remove(path)
+
+    def expire_session(self):
+        """Expire the current session and establish a new one"""
+        self._set_state(KazooState.LOST, KeeperState.EXPIRED_SESSION)
+        with self._lock:
+            self._data_watches.clear()
+            self._child_watches.clear()
+            self._recursive_watches.clear()
+        self.state = KazooState.CONNECTED
+        self._expire_ephemerals()
+        self.start()
+
+    def lose_connection(self):
+        """Lose the connection to the server without losing the session"""
+        self._set_state(KazooState.SUSPENDED, KeeperState.CONNECTING)
+        self._set_state(KazooState.CONNECTED, KeeperState.CONNECTED)
+
+
+class FakeKazooTestCase(unittest.TestCase):
+    """Test case providing a connected `FakeKazooClient` as `client`.
+
+    It mimics `kazoo.testing.KazooTestCase` without needing a
+    ZooKeeper server.
+    """
+
+    LATENCY = 0
+
+    def setUp(self):
+        self.client = FakeKazooClient(latency=self.LATENCY)
+        self.client.start()
+
+    def tearDown(self):
+        if self.client.connected:
+            self.client.stop()
+
+    def expire_session(self):
+        self.client.expire_session()
+
+    def lose_connection(self):
+        self.client.lose_connection()
@@ -3,9 +3,33 @@ import operator
 import logging
 import re
 import time
+import collections
+import os
+import signal
+import subprocess
+import threading
+import zlib
+import io
 from socket import socket, AF_INET, SOCK_DGRAM
 from functools import reduce
 
+from kazoo.exceptions import NoNodeError, ConnectionLoss, OperationTimeoutError
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .metrics import Histogram, histogram_samples
+
 logger = logging.getLogger(__name__)
 
 def ip():
@@ -21,21 +45,126 @@ def ip():
         del s
     return ip
 
-def serialize(data):
+# Payloads not encoded in JSON start with this prefix, which cannot
+# start a UTF-8 JSON document, followed by the tag of their codec or
+# compression
+CODEC_MAGIC = b"\xffzk"
+
+# Codecs by name: (tag, encode, decode)
+CODECS = collections.OrderedDict()
+CODECS["json"] = (None, lambda data: json.dumps(data).encode("utf-8"), json.loads)
+if msgpack is not None:
+    CODECS["msgpack"] = (b"m",
+                         lambda data: msgpack.packb(data, use_bin_type=True),
+                         lambda payload: msgpack.unpackb(payload, raw=False))
+if cbor2 is not None:
+    CODECS["cbor"] = (b"c", cbor2.dumps, cbor2.loads)
+
+DEFAULT_CODEC = "json"
+
+# Compressed payloads are rejected when larger than this once
+# decompressed, in bytes
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+
+
+def _zlib_decompress(payload, max_size):
+    decompressor = zlib.decompressobj()
+    data = decompressor.decompress(payload, max_size + 1)
+    if len(data) > max_size:
+        raise ValueError('Decompressed payload larger than %d bytes' % max_size)
+    if not decompressor.eof:
+        raise ValueError('Truncated compressed payload')
+    return data
+
+
+def _zstd_decompress(payload, max_size):
+    # The size declared in the frame header cannot be trusted
+    reader = zstandard.ZstdDecompressor().stream_reader(io.BytesIO(payload))
+    data = reader.read(max_size + 1)
+    if len(data) > max_size:
+        raise ValueError('Decompressed payload larger than %d bytes' % max_size)
+    return data
+
+
+# Compressions by name: (tag, compress, decompress), `decompress`
+# taking the maximum size of the decompressed payload
+COMPRESSIONS = collections.OrderedDict()
+COMPRESSIONS["zlib"] = (b"z", zlib.compress, _zlib_decompress)
+if zstandard is not None:
+    COMPRESSIONS["zstd"] = (b"s",
+                            lambda payload: zstandard.ZstdCompressor().compress(payload),
+                            _zstd_decompress)
+
+# Payloads are only compressed above this size, in bytes
+DEFAULT_COMPRESS_ABOVE = 4096
+
+
+def serialize(data, codec=DEFAULT_CODEC):
+    try:
+        tag, encode, decode = CODECS[codec]
+    except KeyError:
+        raise ValueError('Unsupported codec: %s' % codec)
     try:
         if type(data) != dict:
             raise TypeError('Must be a dict')
-        return json.dumps(data)
+        if tag is None:
+            return encode(data)
+        return CODEC_MAGIC + tag + encode(data)
     except Exception as e:
         logger.warn('Cannot serialize: %s [%s]', data, e)
-        return '{}'
+        return b'{}'
+
+
+def compress(serialized, compression, above=DEFAULT_COMPRESS_ABOVE):
+    """Compress a serialized payload larger than `above` bytes"""
+    if compression is None or len(serialized) <= above:
+        return serialized
+    try:
+        tag, compress, decompress = COMPRESSIONS[compression]
+    except KeyError:
+        raise ValueError('Unsupported compression: %s' % compression)
+    compressed = CODEC_MAGIC + tag + compress(serialized)
+    logger.debug('Compressed payload with %s from %d to %d bytes (ratio %.2f)',
+                 compression, len(serialized), len(compressed),
+                 float(len(compressed)) / len(serialized))
+    if len(compressed) >= len(serialized):
+        return serialized
+    return compressed
+
+
+def _split(payload):
+    """Return the tag and the body of a payload, no tag for JSON"""
+    if isinstance(payload, bytes) and payload.startswith(CODEC_MAGIC):
+        return payload[len(CODEC_MAGIC):len(CODEC_MAGIC) + 1], payload[len(CODEC_MAGIC) + 1:]
+    return None, payload
+
+
+def _decode(serialized, max_size=MAX_DECOMPRESSED_SIZE):
+    """Decode a payload, whatever its codec and compression.
+
+    At most one compression layer is accepted, decompressed up to
+    `max_size` bytes.
+    """
+    tag, body = _split(serialized)
+    for compression_tag, compress, decompress in COMPRESSIONS.values():
+        if tag is not None and compression_tag == tag:
+            tag, body = _split(decompress(body, max_size))
+            if any(tag == compression[0] for compression in COMPRESSIONS.values()):
+                raise ValueError('Payload compressed more than once')
+            break
+    if tag is None:
+        return json.loads(body)
+    for codec_tag, encode, decode in CODECS.values():
+        if codec_tag == tag:
+            return decode(body)
+    raise ValueError('Unsupported payload tag: %r' % tag)
 
 
 def unserialize(serialized):
     if not serialized:
         return {}
     try:
-        data = json.loads(serialized)
+        data = _decode(serialized)
         if type(data) != dict:
             raise TypeError('Not a dict')
         return data
@@ -44,6 +173,48 @@ def unserialize(serialized):
         return {}
 
 
+DEFAULT_MAX_INFLIGHT = 64
+
+def fetch_many(zkconn, paths, watcher=None, max_inflight=DEFAULT_MAX_INFLIGHT, stat_only=False):
+    """Fetch several znodes using pipelined asynchronous requests.
+
+    At most `max_inflight` requests are sent before waiting for the
+    oldest one to complete. `watcher` is an optional function
+    returning the watch to set for a given path. Return an ordered
+    dictionary mapping each path to its `(data, stat)` tuple, or only
+    to its stat with `stat_only`. Nodes that do not exist are omitted.
+
+    Requests failing because of a connection loss or a timeout are
+    sent again with the retry policy of the client, like synchronous
+    requests.
+    """
+    results = collections.OrderedDict()
+    pending = collections.deque()
+
+    def collect():
+        path, watch, result = pending.popleft()
+        try:
+            try:
+                value = result.get()
+            except (ConnectionLoss, OperationTimeoutError):
+                value = zkconn.retry(retry_request, path, watch=watch)
+        except NoNodeError:
+            return
+        if value is not None:
+            results[path] = value
+
+    request = stat_only and zkconn.exists_async or zkconn.get_async
+    retry_request = stat_only and zkconn.exists or zkconn.get
+    for path in paths:
+        if len(pending) >= max(1, max_inflight):
+            collect()
+        watch = watcher and watcher(path) or None
+        pending.append((path, watch, request(path, watch=watch)))
+    while pending:
+        collect()
+    return results
+
+
 def dict_get_path(the_dict, path):
     try:
         return reduce(operator.getitem, [the_dict] + path.split('.'))
@@ -74,57 +245,213 @@ def dict_filter(the_dict, field_or_fields=None):
         raise TypeError('Invalid type for field path: %s' % type(field_or_fields))
 
 
+OPERATORS = {"==": operator.eq,
+             "=":  operator.eq,
+             "!=": operator.ne,
+             ">=": operator.ge,
+             "<=": operator.le,
+             ">":  operator.gt,
+             "<":  operator.lt}
+
+
 def get_operator(op):
     try:
-        return {"==": operator.eq,
-                "=":  operator.eq,
-                "!=": operator.ne,
-                ">=": operator.ge,
-                "<=": operator.le,
-                ">":  operator.gt,
-                "<":  operator.lt}[op]
+        return OPERATORS[op]
     except KeyError:
         raise ValueError('Unknown operator: %s' % op)
 
 
-def match_predicates(predicates, the_dict):
-    for predicate in predicates:
-        m1, m2 = (dict_get_path(the_dict, predicate['path']), predicate['value'])
-        if m1 is None and m2 is not None:
-            return False
-        try:
-            int(m1)
-            int(m2)
-            m1 = int(m1)
-            m2 = int(m2)
-        except (ValueError, TypeError):
-            pass
-        if not predicate['op'](m1, m2):
-            return False
-    return True
+def compile_path(path):
+    """Return a function getting the value at a dotted `path` of a
+    dictionary, `None` if there is none"""
+    keys = tuple(path.split('.'))
+    if len(keys) == 1:
+        key = keys[0]
 
+        def get(the_dict):
+            try:
+                return the_dict[key]
+            except Exception:
+                return None
+    else:
+        def get(the_dict):
+            try:
+                for key in keys:
+                    the_dict = the_dict[key]
+                return the_dict
+            except Exception:
+                return None
+    return get
 
-def create_filter(filters):
-    if not filters:
-        return lambda a_dict: True
+
+def compile_predicate(path, op, value):
+    """Return a function telling if a dictionary matches a predicate.
+
+    When both the value found at `path` and `value` are integers,
+    they are compared as such. `value` is converted only once.
+    """
+    get = compile_path(path)
+    if value is None:
+        # Existence checks
+        if op is operator.is_:
+            return lambda the_dict: get(the_dict) is None
+        return lambda the_dict: get(the_dict) is not None
+    try:
+        number = int(value)
+    except ValueError:
+        def match(the_dict):
+            found = get(the_dict)
+            return found is not None and op(found, value)
+    else:
+        def match(the_dict):
+            found = get(the_dict)
+            if found is None:
+                return False
+            try:
+                found = int(found)
+            except (ValueError, TypeError):
+                return op(found, value)
+            return op(found, number)
+    return match
+
+
+def _predicate_cost(predicate):
+    """Sort key putting the cheapest predicates first"""
+    path, op, value = predicate
+    if value is None:
+        cost = 0
+    elif op in (operator.eq, operator.ne):
+        cost = 1
+    else:
+        cost = 2
+    return (cost, path.count('.'))
+
+
+def parse_filter(filters):
+    """Return the `(path, operator, value)` predicates of a filter"""
     predicates = []
     for f in filters.replace(' ', '').split(','):
-        predicate = {}
         match = re.split('(!?[^><!=]+)(?:(>=|<=|!=|=|<|>)(.*))?', f, 2)
-        predicate['path'] = match[1]
+        path = match[1]
         if match[2]:
-            predicate['op'] = get_operator(match[2])
-            predicate['value'] = match[3]
+            predicates.append((path, get_operator(match[2]), match[3]))
+        # predicate with not operator/value means "fields exists"
+        elif path[0] == '!':
+            predicates.append((path[1:], operator.is_, None))
         else:
-            # predicate with not operator/value means "fields exists"
-            if predicate['path'][0] == '!':
-                predicate['path'] = predicate['path'][1:]
-                predicate['op'] = operator.is_
-            else:
-                predicate['op'] = operator.is_not
-            predicate['value'] = None
-        predicates.append(predicate)
-    return lambda the_dict: match_predicates(predicates, the_dict)
+            predicates.append((path, operator.is_not, None))
+    return predicates
+
+
+def create_filter(filters):
+    """Compile a filter like `enabled=1,weight>10,!maintenance` into a
+    function telling if a dictionary matches all of its predicates.
+
+    Cheap predicates are evaluated first and evaluation stops at the
+    first one not matching.
+    """
+    if not filters:
+        return lambda a_dict: True
+    predicates = [compile_predicate(*predicate)
+                  for predicate in sorted(parse_filter(filters), key=_predicate_cost)]
+    if len(predicates) == 1:
+        return predicates[0]
+
+    def match_all(the_dict):
+        for predicate in predicates:
+            if not predicate(the_dict):
+                return False
+        return True
+    return match_all
+
+class CommandExecutor(object):
+    """Run a shell command in a dedicated thread each time it is called.
+
+    At most one run is in progress at a time. Calls received while the
+    command is running are merged into a single pending run. A run
+    lasting more than `timeout` seconds is killed.
+
+    `labels` are added to those identifying the metrics of the command.
+    """
+
+    def __init__(self, command, timeout=None, labels=None):
+        self.command = command
+        self.timeout = timeout
+        self.labels = labels or {}
+        self.runs = 0
+        self.merged = 0
+        self.last_duration = None
+        self.last_status = None
+        self.durations = Histogram()
+        self._pending = False
+        self._thread = None
+        self._condition = threading.Condition()
+
+    def __call__(self):
+        with self._condition:
+            if self._pending:
+                self.merged += 1
+                return
+            self._pending = True
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._worker,
+                                                name="changed-cmd")
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                self._pending = False
+            self.run()
+
+    def run(self):
+        """Run the command and wait for its completion"""
+        logger.debug("Execute %r" % self.command)
+        start = time.time()
+        try:
+            process = subprocess.Popen(self.command, shell=True,
+                                       start_new_session=True)
+        except OSError as e:
+            logger.error("Cannot execute %r: %s" % (self.command, e))
+            return
+        try:
+            status = process.wait(timeout=self.timeout)
+        except subprocess.TimeoutExpired:
+            logger.error("Command %r still running after %ss, kill it" % (self.command,
+                                                                         self.timeout))
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            status = process.wait()
+        self._finished(status, start)
+
+    def _finished(self, status, start):
+        """Account for a run started at `start`"""
+        self.runs += 1
+        self.last_status = status
+        self.last_duration = time.time() - start
+        self.durations.observe(self.last_duration)
+        if status != 0:
+            logger.warn("Command %r exited with status %d after %.3fs" % (self.command, status,
+                                                                         self.last_duration))
+        else:
+            logger.info("Command %r succeeded in %.3fs" % (self.command, self.last_duration))
+
+    def collect(self):
+        """Metrics of the command, see `metrics.MetricsRegistry`"""
+        labels = dict(self.labels, command=self.command)
+        return [("zkfarmer_changed_cmd_duration_seconds", "histogram",
+                 "Execution time of the command run on changes",
+                 histogram_samples(self.durations, labels)),
+                ("zkfarmer_changed_cmd_merged_total", "counter",
+                 "Number of runs merged into an already pending run",
+                 [("", labels, self.merged)])]
+
 
 class ColorizingStreamHandler(logging.StreamHandler):
     """Provide a nicer logging output to error output with colors"""
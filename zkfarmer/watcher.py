@@ -9,7 +9,10 @@ import threading
 import queue
 import time
 import itertools
+import heapq
+import collections
 import os
+import fnmatch
 from socket import gethostname
 
 import logging as _logging
@@ -17,9 +20,141 @@ logger = _logging.getLogger(__name__)
 
 from watchdog.observers import Observer
 
-from .utils import serialize, unserialize, ip
-from kazoo.exceptions import NoNodeError, NodeExistsError, ZookeeperError
+from .utils import serialize, unserialize, compress, ip, fetch_many, DEFAULT_MAX_INFLIGHT, \
+    DEFAULT_CODEC, DEFAULT_COMPRESS_ABOVE
+from .metrics import Histogram, histogram_samples
+from .conf import ConfJSON
+from kazoo.exceptions import NoNodeError, NodeExistsError, BadVersionError, ZookeeperError, \
+    UnimplementedError
 from kazoo.client import KazooState, KeeperState, OPEN_ACL_UNSAFE
+from kazoo.protocol.states import EventType
+try:
+    from kazoo.protocol.states import AddWatchMode
+    PERSISTENT_RECURSIVE = AddWatchMode.PERSISTENT_RECURSIVE
+except ImportError:
+    # Mode of the ZooKeeper protocol, for clients without `add_watch()`
+    PERSISTENT_RECURSIVE = 1
+
+# Maximum number of events waiting to be processed
+DEFAULT_MAX_EVENTS = 10000
+
+# Minimum delay between two saves of the snapshot of an exporter
+DEFAULT_SNAPSHOT_INTERVAL = 60
+
+# Local files ignored by the importer: hidden, backup, swap and
+# temporary files of usual editors
+IGNORED_LOCAL_FILES = (".*", "*~", "#*#", "*.swp", "*.swx", "*.tmp", "4913")
+
+class EventQueue(object):
+    """Priority queue of events shared between ZooKeeper, watchdog and
+    main threads.
+
+    Each event targets one of the `watchers` sharing the queue. An
+    idempotent event (queued with `coalesce`) is not queued again
+    while an identical one is still pending. When the queue holds
+    `maxsize` events, producers are blocked until the consumer makes
+    room. Urgent events and events emitted by the consumer thread
+    itself are never blocked.
+    """
+
+    def __init__(self, maxsize=0):
+        self.maxsize = maxsize
+        self.watchers = []
+        self.coalesced = 0
+        # Time spent by events in the queue
+        self.wait_time = Histogram()
+        self.consumer = None
+        self._queue = []
+        self._pending = set()
+        self._counter = itertools.count()
+        self._mutex = threading.Lock()
+        self._not_empty = threading.Condition(self._mutex)
+        self._not_full = threading.Condition(self._mutex)
+
+    def qsize(self):
+        with self._mutex:
+            return len(self._queue)
+
+    def put(self, target, priority, name, args=(), block=True, coalesce=False):
+        """Queue an event. Return `False` if it has been coalesced."""
+        key = None
+        if coalesce:
+            key = (id(target), name, args)
+            try:
+                hash(key)
+            except TypeError:
+                key = None
+        with self._mutex:
+            if key is not None and key in self._pending:
+                self.coalesced += 1
+                return False
+            if block and self.maxsize > 0 and threading.current_thread() is not self.consumer:
+                while len(self._queue) >= self.maxsize:
+                    self._not_full.wait()
+                # Maybe queued while we were waiting
+                if key is not None and key in self._pending:
+                    self.coalesced += 1
+                    return False
+            if key is not None:
+                self._pending.add(key)
+            heapq.heappush(self._queue, ((priority, next(self._counter)), target, name, args, key,
+                                         time.time()))
+            self._not_empty.notify()
+            return True
+
+    def _pop(self):
+        priority, target, name, args, key, queued_at = heapq.heappop(self._queue)
+        self.wait_time.observe(time.time() - queued_at)
+        self._pending.discard(key)
+        self._not_full.notify()
+        return target, priority[0], name, args
+
+    def get(self, timeout=None):
+        """Return the next `(target, priority, name, args)` event.
+
+        Raise `queue.Empty` if nothing is received before `timeout`.
+        """
+        with self._mutex:
+            if timeout is None:
+                while not self._queue:
+                    self._not_empty.wait()
+            else:
+                end = time.time() + timeout
+                while not self._queue:
+                    remaining = end - time.time()
+                    if remaining <= 0:
+                        raise queue.Empty
+                    self._not_empty.wait(remaining)
+            return self._pop()
+
+    def drain(self):
+        """Return all pending events, in priority order"""
+        with self._mutex:
+            return [self._pop() for i in range(len(self._queue))]
+
+    def process(self, batch, ignore_unknown_transitions=False):
+        """Handle a batch of events, then flush all the watchers"""
+        for target, priority, event, args in batch:
+            target._process(priority, event, args, ignore_unknown_transitions)
+        for watcher in self.watchers:
+            watcher.flush()
+
+    def close(self):
+        """Close all the watchers, once they are not run anymore"""
+        for watcher in self.watchers:
+            watcher.close()
+
+    def collect(self):
+        """Metrics of the queue, see `metrics.MetricsRegistry`"""
+        return [("zkfarmer_events_queued", "gauge",
+                 "Number of events waiting to be processed",
+                 [("", {}, self.qsize())]),
+                ("zkfarmer_events_coalesced_total", "counter",
+                 "Number of events merged with an identical pending event",
+                 [("", {}, self.coalesced)]),
+                ("zkfarmer_event_wait_seconds", "histogram",
+                 "Time spent by events in the queue",
+                 histogram_samples(self.wait_time, {}))]
 
 class ZkFarmWatcher(object):
 
@@ -31,9 +166,57 @@ class ZkFarmWatcher(object):
     # executed.
     EVENTS = {}
 
-    def __init__(self, zkconn):
-        self.events = queue.PriorityQueue()
-        self.counter = itertools.count()
+    # EVENTS compiled when the class is created: `(state, event)` is
+    # associated to `(dst, handler)`. `handler` is the method to
+    # execute, either "exec_EVENT_from_STATE" or "exec_EVENT".
+    TRANSITIONS = {}
+
+    # Events which can be merged with an identical pending event
+    COALESCE = ()
+
+    # Time at which flush() should be called again, if any
+    deadline = None
+
+    def __init_subclass__(cls, **kwargs):
+        super(ZkFarmWatcher, cls).__init_subclass__(**kwargs)
+        cls.TRANSITIONS = cls.compile_transitions()
+
+    @classmethod
+    def compile_transitions(cls):
+        """Build the dispatch table of the FSM"""
+        table = {}
+        for event, transitions in cls.EVENTS.items():
+            for src, dst in transitions:
+                if (src, event) in table:
+                    # Only the first matching transition is used
+                    continue
+                handler = getattr(cls, "exec_%s_from_%s" % (event.replace(" ", "_"),
+                                                            src.replace(" ", "_")),
+                                  None)
+                if handler is None:
+                    handler = getattr(cls, "exec_%s" % event.replace(" ", "_"),
+                                      None)
+                table[(src, event)] = (dst, handler)
+        return table
+
+    def __init__(self, zkconn, max_events=DEFAULT_MAX_EVENTS, events=None):
+        # Watchers sharing the same event queue are run by the same loop
+        if events is None:
+            events = EventQueue(max_events)
+        self.events = events
+        self.events.watchers.append(self)
+        self.errors = 0
+        # Duration of handled transitions and count of unknown
+        # transitions, for each `(event, state)`
+        self.timings = collections.defaultdict(Histogram)
+        self.unknown_transitions = collections.Counter()
+        # Number of ZooKeeper reads and writes, bytes read and
+        # configuration writes performed or skipped
+        self.stats = collections.Counter()
+        # Guards the metrics above, collected from another thread
+        self.metrics_lock = threading.Lock()
+        # Last time the local configuration was known to be in sync
+        self.last_sync = None
         self.zkconn = zkconn
         self.zkconn.add_listener(self._zkchange)
         self.state = "initial"
@@ -52,60 +235,154 @@ class ZkFarmWatcher(object):
 
     def event(self, name, *args):
         """Signal a new event to the main thread"""
-        self.events.put(((2, next(self.counter)), name, args))
+        self.events.put(self, 2, name, args, coalesce=name in self.COALESCE)
     def urgent_event(self, name, *args):
         """Signal a new priority event to the main thread"""
-        self.events.put(((1, next(self.counter)), name, args))
+        self.events.put(self, 1, name, args, block=False)
+
+    def flush(self):
+        """Called once all the events of a batch have been handled"""
+        pass
+
+    def close(self):
+        """Called when the loop stops"""
+        pass
+
+    def _count(self, name, value=1):
+        """Add `value` to the `name` statistic"""
+        with self.metrics_lock:
+            self.stats[name] += value
+
+    def _zk_read(self, size=0, count=1):
+        """Account for `count` ZooKeeper reads, returning `size` bytes in total"""
+        with self.metrics_lock:
+            self.stats["zk_reads"] += count
+            self.stats["zk_read_bytes"] += size
+
+    def _conf_write(self, obj):
+        """Write the local configuration and account for it"""
+        if self.conf.write(obj) is False:
+            self._count("conf_writes_skipped")
+        else:
+            self._count("conf_writes")
+
+    def metric_labels(self):
+        """Labels identifying the metrics of this watcher"""
+        return {"watcher": self.__class__.__name__}
+
+    def snapshot_stats(self):
+        """Return a copy of the statistics, safe to read from any thread"""
+        with self.metrics_lock:
+            return collections.Counter(self.stats)
+
+    def collect(self):
+        """Metrics of the watcher, see `metrics.MetricsRegistry`"""
+        labels = self.metric_labels()
+        def with_labels(**extra):
+            result = dict(labels)
+            result.update(extra)
+            return result
+        timings = []
+        with self.metrics_lock:
+            stats = collections.Counter(self.stats)
+            unknown_transitions = sorted(self.unknown_transitions.items())
+            for (event, state), histogram in sorted(self.timings.items()):
+                timings.extend(histogram_samples(histogram, with_labels(event=event, state=state)))
+        metrics = [("zkfarmer_transition_duration_seconds", "histogram",
+                    "Time spent handling an event, by event and source state",
+                    timings),
+                   ("zkfarmer_unknown_transitions_total", "counter",
+                    "Number of events received in a state not handling them",
+                    [("", with_labels(event=event, state=state), count)
+                     for (event, state), count in unknown_transitions]),
+                   ("zkfarmer_zk_reads_total", "counter",
+                    "Number of ZooKeeper read requests",
+                    [("", labels, stats["zk_reads"])]),
+                   ("zkfarmer_zk_writes_total", "counter",
+                    "Number of ZooKeeper write requests",
+                    [("", labels, stats["zk_writes"])]),
+                   ("zkfarmer_zk_read_bytes_total", "counter",
+                    "Number of bytes read from ZooKeeper nodes",
+                    [("", labels, stats["zk_read_bytes"])]),
+                   ("zkfarmer_conf_writes_total", "counter",
+                    "Number of local configuration writes",
+                    [("", with_labels(result="performed"), stats["conf_writes"]),
+                     ("", with_labels(result="skipped"), stats["conf_writes_skipped"])])]
+        if self.last_sync is not None:
+            metrics.append(("zkfarmer_last_sync_timestamp_seconds", "gauge",
+                            "Last time the local configuration was known to be in sync",
+                            [("", labels, self.last_sync)]))
+        return metrics
 
-    def loop(self, count=None, timeout=10, ignore_unknown_transitions=False):
-        errors = 0
+    def loop(self, count=None, timeout=10, ignore_unknown_transitions=False, drain=False):
+        """Process events of all the watchers sharing our event queue.
+
+        When `drain` is true, all the events queued at the time the
+        first one is received are handled before calling `flush()`.
+        """
+        self.events.consumer = threading.current_thread()
+        watchers = self.events.watchers
         while count is None or count > 0:
             if count is not None:
                 count -= 1
 
             # Process pending events
+            wait = timeout
+            deadlines = [w.deadline for w in watchers if w.deadline is not None]
+            if deadlines:
+                wait = max(0, min(timeout, min(deadlines) - time.time()))
             try:
-                priority, event, args = self.events.get(True, timeout=timeout)
+                batch = [self.events.get(timeout=wait)]
             except queue.Empty:
+                if deadlines:
+                    self.events.process([])
                 continue
+            if drain:
+                batch.extend(self.events.drain())
+                if len(batch) > 1:
+                    logger.debug("Process a batch of %d events" % len(batch))
+            self.events.process(batch, ignore_unknown_transitions)
 
-            transition = [t for t in self.EVENTS[event] if t[0] == self.state]
-            if not transition:
-                text = "unknown transition for event %r from state %r" % (event,
-                                                                          self.state)
-                logger.warn(text)
-                if not ignore_unknown_transitions:
-                    raise RuntimeError(text)
-                continue
-            transition = transition[0]
-            logger.debug("Transition from %r to %r next to event %r" % (transition[0],
-                                                                        transition[1],
-                                                                         event))
-            execute = None
-            do = True
-            execute = getattr(self, "exec_%s_from_%s" % (event.replace(" ", "_"),
-                                                         transition[0].replace(" ", "_")),
-                              None)
-            if execute is None:
-                execute = getattr(self, "exec_%s" % event.replace(" ", "_"),
-                                  None)
-            if execute is not None:
-                try:
-                    logger.debug("And execute the appropriate action %r" % execute)
-                    if execute(*args) is False:
-                        do = False
-                    errors = 0
-                except ZookeeperError as e:
-                    logger.exception("Got a zookeeper exception, reschedule the transition")
-                    self.events.put((priority, event, args))
+    def _process(self, priority, event, args, ignore_unknown_transitions):
+        state = self.state
+        try:
+            dst, execute = self.TRANSITIONS[(state, event)]
+        except KeyError:
+            with self.metrics_lock:
+                self.unknown_transitions[(event, state)] += 1
+            text = "unknown transition for event %r from state %r" % (event,
+                                                                      state)
+            logger.warn(text)
+            if not ignore_unknown_transitions:
+                raise RuntimeError(text)
+            return
+        logger.debug("Transition from %r to %r next to event %r" % (state,
+                                                                    dst,
+                                                                    event))
+        do = True
+        if execute is not None:
+            start = time.time()
+            try:
+                logger.debug("And execute the appropriate action %r" % execute.__name__)
+                if execute(self, *args) is False:
                     do = False
-                    errors += 1
-                    if errors > 10:
-                        logger.warn("Too many errors, wait a bit")
-                        time.sleep(2)
-                        errors = 7
-            if do:
-                self.state = transition[1]
+                self.errors = 0
+            except ZookeeperError as e:
+                logger.exception("Got a zookeeper exception, reschedule the transition")
+                self.events.put(self, priority, event, args, block=False,
+                                coalesce=event in self.COALESCE)
+                do = False
+                self.errors += 1
+                if self.errors > 10:
+                    logger.warn("Too many errors, wait a bit")
+                    time.sleep(2)
+                    self.errors = 7
+            finally:
+                elapsed = time.time() - start
+                with self.metrics_lock:
+                    self.timings[(event, state)].observe(elapsed)
+        if do:
+            self.state = dst
 
 class ZkFarmExporter(ZkFarmWatcher):
 
@@ -125,66 +402,342 @@ class ZkFarmExporter(ZkFarmWatcher):
                "connection recovered":   [("lost",      "initial"),
                                           ("idle",      "initial"),
                                           ("initial",   "initial")] }
+    COALESCE = ("children modified", "node modified")
 
-    def __init__(self, zkconn, root_node_path, conf, updated_handler=None, filter_handler=None):
-        super(ZkFarmExporter, self).__init__(zkconn)
+    def __init__(self, zkconn, root_node_path, conf, updated_handler=None, filter_handler=None,
+                 max_inflight=DEFAULT_MAX_INFLIGHT, quiet_period=0, max_staleness=None,
+                 events=None, snapshot=None, persistent_watches=True,
+                 snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL):
+        super(ZkFarmExporter, self).__init__(zkconn, events=events)
         self.root_node_path = root_node_path
         self.conf = conf
         self.updated_handler = updated_handler
         self.filter_handler = filter_handler
+        self.max_inflight = max_inflight
+        # Wait for `quiet_period` seconds without change before writing
+        # the configuration, but never delay a change more than
+        # `max_staleness` seconds.
+        self.quiet_period = quiet_period
+        self.max_staleness = max_staleness
+        self.changed_since = None
+        self.last_change = None
+        self.nodes = {}
+        self.matching = set()
+        # Cached nodes which may have changed since they were fetched
+        self.unverified = set()
+        # Watch the whole farm with a single persistent recursive watch
+        # when the client and the server support it (ZooKeeper 3.6+)
+        # instead of a one-shot watch per node.
+        self.persistent_watches = persistent_watches
+        self.persistent = False
+        # File in which the node cache is saved to start from it, at
+        # most every `snapshot_interval` seconds and when closed
+        self.snapshot = snapshot and ConfJSON(snapshot)
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_pending = False
+        self.last_snapshot = None
+        if self.snapshot:
+            self._load_snapshot()
 
         self.event("initial setup")
 
+    def _load_snapshot(self):
+        """Fill the node cache from the snapshot, if any"""
+        try:
+            snapshot = self.snapshot.read()
+            if snapshot is None:
+                return
+            if snapshot.get("znode") != self.root_node_path:
+                raise ValueError("snapshot of %s" % snapshot.get("znode"))
+            nodes = dict((name, (int(mzxid), info))
+                         for name, (mzxid, info) in snapshot["nodes"].items())
+        except (EnvironmentError, ValueError, TypeError, KeyError, AttributeError) as e:
+            logger.warn("Ignoring snapshot %s: %s" % (self.snapshot.file_path, e))
+            return
+        self.nodes = nodes
+        self.matching = set(name for name, (mzxid, info) in nodes.items()
+                            if not self.filter_handler or self.filter_handler(info))
+        logger.info("Loaded %d nodes from snapshot %s" % (len(nodes), self.snapshot.file_path))
+
+    def _save_snapshot(self):
+        """Save the node cache with the version of each node"""
+        try:
+            self.snapshot.write({"znode": self.root_node_path,
+                                 "nodes": dict((name, [mzxid, info])
+                                               for name, (mzxid, info) in self.nodes.items())})
+        except (EnvironmentError, ValueError, TypeError) as e:
+            logger.warn("Cannot save snapshot %s: %s" % (self.snapshot.file_path, e))
+
+    def metric_labels(self):
+        labels = super(ZkFarmExporter, self).metric_labels()
+        labels["znode"] = self.root_node_path
+        # A farm can be exported to several configurations
+        labels["conf"] = self.conf.file_path
+        return labels
+
+    def collect(self):
+        labels = self.metric_labels()
+        stats = self.snapshot_stats()
+        matching = len(self.matching)
+        return super(ZkFarmExporter, self).collect() + [
+            ("zkfarmer_nodes", "gauge",
+             "Number of nodes in the farm, by filter result",
+             [("", dict(labels, filter="matched"), matching),
+              ("", dict(labels, filter="excluded"), len(self.nodes) - matching)]),
+            ("zkfarmer_node_updates_filtered_total", "counter",
+             "Number of node updates not changing the filtered configuration",
+             [("", labels, stats["node_updates_filtered"])]),
+            ("zkfarmer_nodes_revalidated_total", "counter",
+             "Number of cached nodes checked again after a restart or a reconnection, by result",
+             [("", dict(labels, result="unchanged"), stats["nodes_unchanged"]),
+              ("", dict(labels, result="changed"), stats["nodes_changed"])])]
+
     def watch_children(self, _):
         self.event("children modified")
     def watch_node(self, what):
         self.event("node modified", what)
+    def watch_tree(self, what):
+        # Only children of the root are nodes of the farm
+        if what.path.startswith(self.root_node_path + '/') and \
+           '/' not in what.path[len(self.root_node_path) + 1:]:
+            self.event("node modified", what)
 
     def get_watcher_node(self, path):
-        if path in self.monitored:
+        if self.persistent or path in self.monitored:
             return None         # Already monitored
-        self.monitored.append(path)
+        self.monitored.add(path)
         return self.watch_node
 
+    def _add_persistent_watch(self):
+        """Watch the farm with a persistent recursive watch, if possible"""
+        add_watch = getattr(self.zkconn, "add_watch", None)
+        if not self.persistent_watches or add_watch is None:
+            return False
+        try:
+            add_watch(self.root_node_path, self.watch_tree, PERSISTENT_RECURSIVE)
+        except UnimplementedError:
+            logger.info("Persistent watches not supported by the server, "
+                        "watching each node of %s" % self.root_node_path)
+            self.persistent_watches = False
+            return False
+        return True
+
     def exec_connection_recovered(self):
         """The connection is reestablished"""
         logger.info("Connnection with Zookeeper reestablished")
         self.event("initial setup")
 
     def exec_initial_setup(self):
-        """Watch for new children"""
-        self.monitored = []
+        """Watch for new children.
+
+        Watches are lost, but the node cache is kept: nodes are checked
+        again with their stat and only fetched again if modified.
+        """
+        self.monitored = set()
         self.root_monitored = False
+        self.unverified = set(self.nodes)
         try:
             self.zkconn.ensure_path(self.root_node_path, acl=OPEN_ACL_UNSAFE)
         except NodeExistsError:
             pass
+        self.persistent = self._add_persistent_watch()
         self.event("children modified")
     def exec_initial_setup_from_idle(self):
         # This may happen because we recovered the connection several times
         pass
 
+    def _fetch_node(self, name):
+        """Fetch a child into the node cache.
+
+        Return `True` if the cached content has been modified.
+        """
+        subnode_path = '%s/%s' % (self.root_node_path, name)
+        try:
+            data, stat = self.zkconn.get(subnode_path,
+                                         watch=self.get_watcher_node(subnode_path))
+            self._zk_read(len(data or b""))
+        except NoNodeError:
+            # Vanished since we listed it, the children watch will tell us
+            self.monitored.discard(subnode_path)
+            return name in self.nodes and self._forget_node(name)
+        return self._cache_node(name, data, stat)
+
+    def _fetch_nodes(self, names):
+        """Fetch several children into the node cache at once.
+
+        Return `True` if the filtered content has been modified.
+        """
+        paths = ['%s/%s' % (self.root_node_path, name) for name in names]
+        results = fetch_many(self.zkconn, paths,
+                             watcher=self.get_watcher_node,
+                             max_inflight=self.max_inflight)
+        self._zk_read(sum(len(data or b"") for data, stat in results.values()),
+                      count=len(paths))
+        modified = False
+        for name, path in zip(names, paths):
+            if path in results:
+                if self._cache_node(name, *results[path]):
+                    modified = True
+            else:
+                # Vanished since we listed it, no watch has been set
+                self.monitored.discard(path)
+        return modified
+
+    def _verify_nodes(self, names):
+        """Watch cached nodes again and fetch those modified since they
+        were cached.
+
+        Return `True` if the filtered content has been modified.
+        """
+        paths = ['%s/%s' % (self.root_node_path, name) for name in names]
+        stats = fetch_many(self.zkconn, paths,
+                           watcher=self.get_watcher_node,
+                           max_inflight=self.max_inflight,
+                           stat_only=True)
+        self._zk_read(count=len(paths))
+        modified = False
+        changed = []
+        for name, path in zip(names, paths):
+            stat = stats.get(path)
+            if stat is None:
+                # Vanished since we listed it
+                if self._forget_node(name):
+                    modified = True
+            elif stat.mzxid != self.nodes[name][0]:
+                changed.append(name)
+        self._count("nodes_unchanged", len(names) - len(changed))
+        self._count("nodes_changed", len(changed))
+        if changed and self._fetch_nodes(changed):
+            modified = True
+        return modified
+
+    def _cache_node(self, name, data, stat):
+        """Store a child into the node cache.
+
+        Return `True` if the filtered content has been modified: the
+        node is accepted by the filter or it was before.
+        """
+        cached = self.nodes.get(name)
+        if cached is not None and cached[0] == stat.mzxid:
+            return False
+        info = unserialize(data)
+        self.nodes[name] = (stat.mzxid, info)
+        if not self.filter_handler or self.filter_handler(info):
+            self.matching.add(name)
+            return True
+        if name in self.matching:
+            self.matching.remove(name)
+            return True
+        self._count("node_updates_filtered")
+        return False
+
+    def _forget_node(self, name):
+        """Remove a child from the node cache.
+
+        Return `True` if the filtered content has been modified.
+        """
+        del self.nodes[name]
+        if name in self.matching:
+            self.matching.remove(name)
+            return True
+        return False
+
+    def _changed(self):
+        """Record a change of the node cache"""
+        self.last_change = time.time()
+        if self.changed_since is None:
+            self.changed_since = self.last_change
+
+    def _defer(self, deadline):
+        """Get flushed again at `deadline`"""
+        if self.deadline is None or deadline < self.deadline:
+            self.deadline = deadline
+
+    def flush(self):
+        """Write the configuration built from the node cache, and its
+        snapshot when due"""
+        self.deadline = None
+        if self.changed_since is not None:
+            self._flush_conf()
+        if self.snapshot_pending:
+            self._flush_snapshot()
+
+    def _flush_conf(self):
+        deadline = self.last_change + self.quiet_period
+        if self.max_staleness is not None:
+            deadline = min(deadline, self.changed_since + self.max_staleness)
+        if time.time() < deadline:
+            self._defer(deadline)
+            return
+        self.changed_since = None
+        new_conf = dict((name, self.nodes[name][1]) for name in self.matching)
+        self._conf_write(new_conf)
+        self.snapshot_pending = bool(self.snapshot)
+        self.last_sync = time.time()
+        if self.updated_handler:
+            self.updated_handler()
+
+    def _flush_snapshot(self):
+        # The whole cache is saved, do not do it for every change
+        if self.last_snapshot is not None:
+            deadline = self.last_snapshot + self.snapshot_interval
+            if time.time() < deadline:
+                self._defer(deadline)
+                return
+        self.snapshot_pending = False
+        self.last_snapshot = time.time()
+        self._save_snapshot()
+
+    def close(self):
+        if self.snapshot_pending:
+            self.snapshot_pending = False
+            self._save_snapshot()
+
     def exec_children_modified(self):
         self.root_monitored = False
     def exec_children_modified_from_idle(self):
-        """A change has occurred on a child"""
-        new_conf = {}
-        nodes = self.zkconn.get_children(self.root_node_path,
-                                         watch=(self.root_monitored and None or self.watch_children))
-        for name in nodes:
-            subnode_path = '%s/%s' % (self.root_node_path, name)
-            info = unserialize(self.zkconn.get(subnode_path,
-                                               watch=self.get_watcher_node(subnode_path))[0])
-            if not self.filter_handler or self.filter_handler(info):
-                new_conf[name] = info
-        self.conf.write(new_conf)
-        if self.updated_handler:
-            self.updated_handler()
+        """The list of children may have changed"""
+        if self.persistent or self.root_monitored:
+            watch = None
+        else:
+            watch = self.watch_children
+        nodes = set(self.zkconn.get_children(self.root_node_path, watch=watch))
+        self._zk_read()
+        # The configuration is written at least once
+        modified = self.last_sync is None
+        for name in set(self.nodes) - nodes:
+            if self._forget_node(name):
+                modified = True
+            self.monitored.discard('%s/%s' % (self.root_node_path, name))
+        if self.unverified:
+            unverified, self.unverified = self.unverified & nodes, set()
+            if self._verify_nodes(sorted(unverified)):
+                modified = True
+        if self._fetch_nodes(sorted(nodes - set(self.nodes))):
+            modified = True
+        if modified:
+            self._changed()
 
     def exec_node_modified(self, what):
         """A change has occurred inside the node"""
-        self.monitored.remove(what.path)
-        self.event("children modified")
+        self.monitored.discard(what.path)
+    def exec_node_modified_from_idle(self, what):
+        """A change has occurred inside the node, refresh only this one"""
+        self.exec_node_modified(what)
+        name = what.path[len(self.root_node_path) + 1:]
+        if name not in self.nodes:
+            # Unless watched by a persistent watch, new nodes are
+            # notified by the children watch
+            if self.persistent and what.type != EventType.DELETED and self._fetch_node(name):
+                self._changed()
+            return
+        if what.type == EventType.DELETED:
+            # Forget it, the children or the persistent watch will
+            # tell us if it is recreated in the meantime
+            if self._forget_node(name):
+                self._changed()
+        elif self._fetch_node(name):
+            self._changed()
 
 class ZkFarmImporter(ZkFarmWatcher):
 
@@ -206,16 +759,46 @@ class ZkFarmImporter(ZkFarmWatcher):
                                           ("lost",      "lost")],
                "connection recovered":   [("lost",      "observer ready"),
                                           ("observer ready", "observer ready")]}
+    COALESCE = ("znode modified", "local modified")
 
-    def __init__(self, zkconn, root_node_path, conf, common=False):
-        super(ZkFarmImporter, self).__init__(zkconn)
+    def __init__(self, zkconn, root_node_path, conf, common=False, debounce=0,
+                 codec=DEFAULT_CODEC, compression=None, compress_above=DEFAULT_COMPRESS_ABOVE,
+                 events=None, observer=None):
+        super(ZkFarmImporter, self).__init__(zkconn, events=events)
         self.conf = conf
+        # Started watchdog observer to use instead of our own
+        self.observer = observer
         self.common = common
+        # Codec used to encode our node, see `utils.CODECS`, and
+        # compression applied when larger than `compress_above` bytes
+        self.codec = codec
+        self.compression = compression
+        self.compress_above = compress_above
+        # Local events received during `debounce` seconds after a
+        # first one are handled together
+        self.debounce = debounce
+        self.local_since = None
+        self.local_events = 0
         self.node_path = "%s/%s" % (root_node_path,
                                     common and "common" or ip())
+        # Local paths modified since the last read, and whether the
+        # whole configuration should be read instead
+        self.local_changes = set()
+        self.local_resync = False
+        # Guards the local state above, updated by the observer thread
+        self.local_lock = threading.Lock()
+        # Last known remote configuration and version. It is known to
+        # be up to date while our node is `monitored` by a watch.
+        self.remote = None
+        self.monitored = False
 
         self.event("initial setup")
 
+    def metric_labels(self):
+        labels = super(ZkFarmImporter, self).metric_labels()
+        labels["znode"] = self.node_path
+        return labels
+
     def _safe_local_conf(self):
         """Return the current local configuration or {} on errors"""
         try:
@@ -232,22 +815,56 @@ class ZkFarmImporter(ZkFarmWatcher):
     def exec_initial_setup(self):
         """Non-zookeeper related initial setup"""
         # Setup observer
-        observer = Observer()
+        observer = self.observer
+        if observer is None:
+            observer = Observer()
+            observer.start()
         path = self.conf.file_path
         if not os.path.isdir(path):
             path = os.path.dirname(os.path.realpath(path))
         observer.schedule(self, path=path, recursive=True)
-        observer.start()
 
         self.mzxid = None
         self.event("initial znode setup")
 
+    def watch_node(self, what):
+        self.monitored = False
+
+    def _serialize(self, conf):
+        """Encode the content of our node"""
+        serialized = serialize(conf, self.codec)
+        payload = compress(serialized, self.compression, self.compress_above)
+        self._count("payload_bytes", len(serialized))
+        self._count("payload_stored_bytes", len(payload))
+        return payload
+
+    def _read_remote(self):
+        """Read the remote configuration and watch for its modifications"""
+        watch = not self.monitored and self.watch_node or None
+        self.monitored = True
+        try:
+            data, stat = self.zkconn.get(self.node_path, watch=watch)
+        except NoNodeError:
+            self.monitored = False
+            self.remote = None
+            raise
+        self._zk_read(len(data or b""))
+        conf = unserialize(data)
+        self.remote = (conf, stat.version)
+        return conf, stat
+
     def exec_initial_znode_setup(self):
         """Initial setup of znode"""
+        # Watches do not survive a session
+        self.remote = None
+        self.monitored = False
         try:
             self.zkconn.ensure_path(os.path.dirname(self.node_path))
-            self.zkconn.create(self.node_path, serialize(self._safe_local_conf()),
+            self._count("zk_writes")
+            local_conf = self._safe_local_conf()
+            self.zkconn.create(self.node_path, self._serialize(local_conf),
                                acl=OPEN_ACL_UNSAFE, ephemeral=(not self.common))
+            self.remote = (local_conf, 0)
         except NodeExistsError:
             # Already exists.
             if self.common:
@@ -255,6 +872,8 @@ class ZkFarmImporter(ZkFarmWatcher):
                 self.event("znode modified")
             else:
                 # Our content is authoritative.
+                with self.local_lock:
+                    self.local_resync = True
                 self.event("local modified")
 
     def exec_initial_znode_setup_from_idle(self):
@@ -267,35 +886,143 @@ class ZkFarmImporter(ZkFarmWatcher):
         pass
     def exec_local_modified_from_idle(self):
         """Check a local modification"""
-        current_conf = unserialize(self.zkconn.get(self.node_path)[0])
+        with self.local_lock:
+            if self.local_since is not None and self.debounce:
+                deadline = self.local_since + self.debounce
+                if time.time() < deadline:
+                    self.deadline = deadline
+                    return
+            self.local_since = self.deadline = None
+            events, self.local_events = self.local_events, 0
+            changed = sorted(self.local_changes)
+            self.local_changes.clear()
+            resync, self.local_resync = self.local_resync, False
+        if events > 1:
+            logger.debug("Handle %d local events at once" % events)
+            self._count("local_events_collapsed", events - 1)
+        if not changed and not resync:
+            # Already handled with a previous event
+            return
         try:
-            new_conf = self.conf.read()
+            new_conf = self.conf.read(changed=None if resync else changed)
         except Exception as e:
             logger.warn("Ignoring invalid local configuration: %s" % e)
+            self._restore_local_changes(changed, resync)
             return
+        try:
+            self._push_local(new_conf)
+        except:
+            # The transition is retried, it has the same changes to handle
+            self._restore_local_changes(changed, resync)
+            raise
+
+    def _restore_local_changes(self, changed, resync):
+        """Put back local changes which could not be handled"""
+        with self.local_lock:
+            self.local_changes.update(changed)
+            self.local_resync = self.local_resync or resync
+
+    def _push_local(self, new_conf):
+        """Write the local configuration to our node when it differs"""
+        if self.remote is None or (self.remote[0] == new_conf and not self.monitored):
+            # We cannot tell if the remote configuration differs
+            current_conf, version = self._read_remote()[0], self.remote[1]
+        else:
+            current_conf, version = self.remote
         if current_conf != new_conf:
             logger.info('Local conf changed')
             logger.debug('Previous conf:   %r' % current_conf)
             logger.debug('New conf:        %r' % new_conf)
-            s = self.zkconn.set(self.node_path, serialize(new_conf))
+            payload = self._serialize(new_conf)
+            try:
+                s = self.zkconn.set(self.node_path, payload, version=version)
+            except BadVersionError:
+                # Modified by someone else since we last read it
+                logger.debug('Remote conf modified concurrently, read it again')
+                current_conf, stat = self._read_remote()
+                if current_conf == new_conf:
+                    self.last_sync = time.time()
+                    return
+                s = self.zkconn.set(self.node_path, payload, version=stat.version)
+            self._count("zk_writes")
+            self.remote = (new_conf, s.version)
             self.mzxid = s.mzxid # Record latest mzxid
+        self.last_sync = time.time()
+
+    def flush(self):
+        if self.deadline is not None and time.time() >= self.deadline:
+            self.deadline = None
+            self.event("local modified")
+
+    def _tracked(self, path):
+        """Tell if a local path is part of the configuration"""
+        root = self.conf.file_path
+        if path == root:
+            return True
+        if not path.startswith(root.rstrip(os.sep) + os.sep):
+            return False
+        name = os.path.basename(path)
+        return not any(fnmatch.fnmatch(name, pattern) for pattern in IGNORED_LOCAL_FILES)
 
     def dispatch(self, event):
         """A local change has occured"""
-        if hasattr(event, "src_path") and event.src_path.startswith(self.conf.file_path) \
-           or hasattr(event, "dst_path") and event.dst_path.startswith(self.conf.file_path) \
-           or hasattr(event, "dest_path") and event.dest_path.startswith(self.conf.file_path):
-            self.event("local modified")
+        paths = []
+        if not (getattr(event, "is_directory", False)
+                and getattr(event, "event_type", None) == "modified"):
+            # A modified directory is also reported by its entries
+            for attr in ("src_path", "dst_path", "dest_path"):
+                path = getattr(event, attr, None)
+                if path and self._tracked(path):
+                    paths.append(path)
+        if not paths:
+            self._count("local_events_ignored")
+            return
+        with self.local_lock:
+            self.local_changes.update(paths)
+            self.local_events += 1
+            if self.local_since is None:
+                self.local_since = time.time()
+        self.event("local modified")
+
+    def collect(self):
+        labels = self.metric_labels()
+        stats = self.snapshot_stats()
+        def with_reason(reason):
+            result = dict(labels)
+            result["reason"] = reason
+            return result
+        metrics = super(ZkFarmImporter, self).collect() + [
+            ("zkfarmer_local_events_suppressed_total", "counter",
+             "Number of local filesystem events not leading to a synchronization",
+             [("", with_reason("ignored"), stats["local_events_ignored"]),
+              ("", with_reason("collapsed"), stats["local_events_collapsed"])]),
+            ("zkfarmer_payload_bytes_total", "counter",
+             "Size of the content written to our node, before compression",
+             [("", labels, stats["payload_bytes"])]),
+            ("zkfarmer_payload_stored_bytes_total", "counter",
+             "Size of the content written to our node, after compression",
+             [("", labels, stats["payload_stored_bytes"])])]
+        if stats["payload_bytes"]:
+            metrics.append(("zkfarmer_payload_compression_ratio", "gauge",
+                            "Ratio between stored and encoded sizes of the content written to our node",
+                            [("", labels, float(stats["payload_stored_bytes"]) /
+                              stats["payload_bytes"])]))
+        return metrics
 
 class ZkFarmJoiner(ZkFarmImporter):
 
     def __init__(self, zkconn, root_node_path, conf, common=False,
-                 updated_handler=None):
+                 updated_handler=None, debounce=0, codec=DEFAULT_CODEC,
+                 compression=None, compress_above=DEFAULT_COMPRESS_ABOVE,
+                 events=None, observer=None):
         self.updated_handler = updated_handler
         super(ZkFarmJoiner, self).__init__(zkconn, root_node_path,
-                                           conf, common)
+                                           conf, common, debounce, codec,
+                                           compression, compress_above,
+                                           events, observer)
 
     def watch_node(self, what):
+        super(ZkFarmJoiner, self).watch_node(what)
         self.event("znode modified")
 
     def exec_initial_setup(self):
@@ -304,7 +1031,7 @@ class ZkFarmJoiner(ZkFarmImporter):
         info = self._safe_local_conf()
         if not self.common:
             info['hostname'] = gethostname()
-        self.conf.write(info)
+        self._conf_write(info)
         if self.updated_handler:
             self.updated_handler()
 
@@ -313,11 +1040,7 @@ class ZkFarmJoiner(ZkFarmImporter):
     def exec_initial_znode_setup(self):
         super(ZkFarmJoiner, self).exec_initial_znode_setup()
         # Setup the watcher
-        self.zkconn.get(self.node_path, self.watch_node)
-        self.monitored = True
-
-    def exec_znode_modified(self):
-        self.monitored = False
+        self._read_remote()
 
     def exec_znode_modified_from_idle(self):
         """Check remote modification"""
@@ -327,20 +1050,19 @@ class ZkFarmJoiner(ZkFarmImporter):
             logger.warn("Ignoring incorrect local configuration: %s" % e)
             current_conf = {}
         try:
-            new = self.zkconn.get(self.node_path,
-                                  watch=(self.monitored and None or self.watch_node))
-            if new[1].mzxid <= self.mzxid:
+            new_conf, stat = self._read_remote()
+            if self.mzxid is not None and stat.mzxid <= self.mzxid:
                 logger.debug('Discard remote modification older than '
-                             'latest local modification (%r <= %r)' % (new[1].mzxid, self.mzxid))
+                             'latest local modification (%r <= %r)' % (stat.mzxid, self.mzxid))
                 return
-            new_conf = unserialize(new[0])
             if current_conf != new_conf:
                 logger.info('Remote conf changed')
                 logger.debug('Previous conf: %r' % current_conf)
                 logger.debug('New conf:      %r' % new_conf)
-                self.conf.write(new_conf)
+                self._conf_write(new_conf)
                 if self.updated_handler:
                     self.updated_handler()
+            self.last_sync = time.time()
         except NoNodeError:
             logger.warn("not able to watch for node %s: not exist anymore" % self.node_path)
 
@@ -5,22 +5,79 @@
 # For the full copyright and license information, please view the LICENSE
 # file that was distributed with this source code.
 
-from .utils import serialize, unserialize, dict_set_path, dict_filter, create_filter
-from .watcher import ZkFarmJoiner, ZkFarmExporter, ZkFarmImporter
+import collections
+
+from .utils import serialize, unserialize, dict_set_path, dict_filter, create_filter, \
+    fetch_many, DEFAULT_MAX_INFLIGHT, CODECS, DEFAULT_CODEC, DEFAULT_COMPRESS_ABOVE
+from .watcher import ZkFarmJoiner, ZkFarmExporter, ZkFarmImporter, EventQueue, DEFAULT_MAX_EVENTS, \
+    DEFAULT_SNAPSHOT_INTERVAL
 
 from kazoo.client import OPEN_ACL_UNSAFE
 from kazoo.exceptions import NoNodeError, BadVersionError
 
+import logging as _logging
+logger = _logging.getLogger(__name__)
+
 class ZkFarmer(object):
     STATUS_OK = 0
     STATUS_WARNING = 1
     STATUS_CRITICAL = 2
     STATUS_UNKNOWN = 3
 
-    def __init__(self, zkconn):
+    def __init__(self, zkconn, max_inflight=DEFAULT_MAX_INFLIGHT, metrics=None, engine=None):
         self.zkconn = zkconn
-
-    def join(self, zknode, conf, common=False, updated_handler=None):
+        self.max_inflight = max_inflight
+        self.metrics = metrics
+        # Optional `aio.AsyncEngine` running the watchers
+        self.engine = engine
+
+    def _register(self, watcher):
+        """Expose the metrics of a watcher and of its event queue"""
+        if self.metrics is not None:
+            self.metrics.register(watcher.events)
+            self.metrics.register(watcher)
+        return watcher
+
+    def _events(self):
+        """Event queue for new watchers, None for a dedicated one"""
+        if self.engine is not None:
+            return self.engine.events
+        return None
+
+    def _observer(self):
+        if self.engine is not None:
+            return self.engine.observer
+        return None
+
+    def _run(self, watcher):
+        """Process events until the end of times, or until exiting"""
+        try:
+            if self.engine is not None:
+                self.engine.run_forever()
+            else:
+                watcher.loop(ignore_unknown_transitions=True, drain=True)
+        finally:
+            watcher.events.close()
+
+    def _codec(self, zknode, codec=None):
+        """Return the codec of the nodes of a farm.
+
+        Unless given, it is the `codec' property of the farm, falling
+        back to json when not supported here, as every exporter can
+        decode it.
+        """
+        if codec is None:
+            codec = self.get(zknode).get('codec') or DEFAULT_CODEC
+            if codec not in CODECS:
+                logger.warn("Unsupported codec %r for farm %s, use %s" % (codec, zknode,
+                                                                         DEFAULT_CODEC))
+                codec = DEFAULT_CODEC
+        if codec not in CODECS:
+            raise ValueError('Unsupported codec: %s' % codec)
+        return codec
+
+    def join(self, zknode, conf, common=False, updated_handler=None, debounce=0,
+             codec=None, compression=None, compress_above=DEFAULT_COMPRESS_ABOVE):
         # Create farms ZkNode if doesn't already exists
         self.zkconn.retry(self.zkconn.ensure_path, zknode, acl=OPEN_ACL_UNSAFE)
         # If we are going to enlarged the farm max seen size, store it
@@ -29,16 +86,55 @@ class ZkFarmer(object):
             if current_size > self.get(zknode, 'size'):
                 self.set(zknode, 'size', current_size)
         # Join the farm
-        ZkFarmJoiner(self.zkconn, zknode, conf, common,
-                     updated_handler).loop(ignore_unknown_transitions=True)
-
-    def importer(self, zknode, conf, common=False):
-        ZkFarmImporter(self.zkconn, zknode, conf, common).loop(ignore_unknown_transitions=True)
-
-    def export(self, zknode, conf, updated_handler=None, filters=None):
-        ZkFarmExporter(self.zkconn, zknode, conf,
-                       updated_handler,
-                       filter_handler=create_filter(filters)).loop(ignore_unknown_transitions=True)
+        joiner = ZkFarmJoiner(self.zkconn, zknode, conf, common,
+                              updated_handler, debounce, self._codec(zknode, codec),
+                              compression, compress_above, self._events(), self._observer())
+        self._run(self._register(joiner))
+
+    def importer(self, zknode, conf, common=False, debounce=0, codec=None,
+                 compression=None, compress_above=DEFAULT_COMPRESS_ABOVE):
+        importer = ZkFarmImporter(self.zkconn, zknode, conf,
+                                  common, debounce, self._codec(zknode, codec),
+                                  compression, compress_above, self._events(), self._observer())
+        self._run(self._register(importer))
+
+    def export(self, zknode, conf, updated_handler=None, filters=None,
+               quiet_period=0, max_staleness=None, snapshot=None,
+               snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL):
+        exporter = ZkFarmExporter(self.zkconn, zknode, conf,
+                                  updated_handler,
+                                  filter_handler=create_filter(filters),
+                                  max_inflight=self.max_inflight,
+                                  quiet_period=quiet_period,
+                                  max_staleness=max_staleness,
+                                  events=self._events(),
+                                  snapshot=snapshot,
+                                  snapshot_interval=snapshot_interval)
+        self._run(self._register(exporter))
+
+    def export_many(self, exports, quiet_period=0, max_staleness=None,
+                    snapshot_interval=DEFAULT_SNAPSHOT_INTERVAL):
+        """Export several farms using a single event loop.
+
+        `exports` is a list of dictionaries with `zknode` and `conf`
+        keys and optional `updated_handler`, `filters` and `snapshot`
+        keys.
+        """
+        events = self._events()
+        if events is None:
+            events = EventQueue(DEFAULT_MAX_EVENTS)
+        exporters = [self._register(ZkFarmExporter(self.zkconn, export['zknode'], export['conf'],
+                                    export.get('updated_handler'),
+                                    filter_handler=create_filter(export.get('filters')),
+                                    max_inflight=self.max_inflight,
+                                    quiet_period=quiet_period,
+                                    max_staleness=max_staleness,
+                                    events=events,
+                                    snapshot=export.get('snapshot'),
+                                    snapshot_interval=snapshot_interval))
+                     for export in exports]
+        if exporters:
+            self._run(exporters[0])
 
     def list(self, zknode):
         try:
@@ -53,6 +149,26 @@ class ZkFarmer(object):
             return {'size': 0}
         return dict_filter(unserialize(data), field_or_fields)
 
+    def get_many(self, zknode, names=None, field_or_fields=None):
+        """Get the information of several children of a node at once.
+
+        Children are fetched concurrently, at most `max_inflight` at a
+        time. Unless `names` are given, all the children are fetched.
+        Return an ordered dictionary mapping names to information,
+        without the children which do not exist.
+        """
+        if names is None:
+            names = self.list(zknode)
+        prefix = zknode.rstrip('/')
+        results = fetch_many(self.zkconn, ['%s/%s' % (prefix, name) for name in names],
+                             max_inflight=self.max_inflight)
+        infos = collections.OrderedDict()
+        for name in names:
+            result = results.get('%s/%s' % (prefix, name))
+            if result is not None:
+                infos[name] = dict_filter(unserialize(result[0]), field_or_fields)
+        return infos
+
     def _save_safe(self, zknode, info, data):
         retry = 3
         while retry:
@@ -97,10 +213,14 @@ class ZkFarmer(object):
         else:
             warn_failed = None
 
+        vanished = 0
         if 'running_filter' in props:
             filter_handler = create_filter(props['running_filter'])
-            for name in self.list(zknode):
-                info = self.get('%s/%s' % (zknode.rstrip('/'), name))
+            names = self.list(zknode)
+            infos = self.get_many(zknode, names)
+            # Nodes removed since listed are not running
+            vanished = len(names) - len(infos)
+            for info in infos.values():
                 if filter_handler(info):
                     running += 1
         else:
@@ -114,4 +234,7 @@ class ZkFarmer(object):
         else:
             status = self.STATUS_OK
 
-        return (status, "%d/%d nodes running, %d nodes failing, max allowed %s" % (running, size, failed, max_failed_node))
+        reason = "%d/%d nodes running, %d nodes failing, max allowed %s" % (running, size, failed, max_failed_node)
+        if vanished:
+            reason += ", %d nodes left during the check" % vanished
+        return (status, reason)